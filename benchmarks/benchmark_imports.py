@@ -0,0 +1,65 @@
+"""
+Checks that importing the cli & flask integration of mara_metabase stays fast
+
+Runs `python -X importtime -c "import <module>"` in fresh interpreters and fails when the import of a module
+takes longer than its budget or pulls in modules that are only needed for actually running a sync.
+
+Usage: python benchmarks/benchmark_imports.py [--runs 5] [--budget-factor 1.0]
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+# module -> (budget in milliseconds for the cumulative import time, modules that must not be imported)
+budgets = {
+    'mara_metabase.cli': (150, ['requests', 'flask', 'mara_schema', 'mara_acl', 'mara_db', 'bcrypt', 'psycopg2']),
+    'mara_metabase.views': (500, ['requests', 'mara_schema', 'mara_acl', 'mara_db', 'bcrypt', 'psycopg2']),
+}
+
+
+def import_times(module: str) -> {str: (float, float)}:
+    """Imports a module in a new interpreter and returns (self, cumulative) milliseconds for each imported module"""
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stderr
+    times = {}
+    for line in output.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|\s+(\S+)', line)
+        if match:
+            times[match.group(3)] = (int(match.group(1)) / 1000, int(match.group(2)) / 1000)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='Number of imports per module, the fastest one counts')
+    parser.add_argument('--budget-factor', type=float, default=1.0, help='Multiplies all budgets (for slow machines)')
+    args = parser.parse_args()
+
+    failed = False
+    for module, (budget, forbidden_modules) in budgets.items():
+        runs = [import_times(module) for _ in range(args.runs)]
+        times = min(runs, key=lambda times: times[module][1])
+        milliseconds = times[module][1]
+        budget *= args.budget_factor
+
+        print(f'{module}: {milliseconds:.1f} ms (budget {budget:.0f} ms)')
+        for name, (_, cumulative) in sorted(times.items(), key=lambda item: -item[1][1])[1:6]:
+            print(f'    {cumulative:8.1f} ms  {name}')
+
+        if milliseconds > budget:
+            print('    over budget', file=sys.stderr)
+            failed = True
+        unexpected = sorted(name for name in times if name.split('.')[0] in forbidden_modules)
+        if unexpected:
+            print(f'    imports {", ".join(unexpected)}', file=sys.stderr)
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
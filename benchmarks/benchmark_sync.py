@@ -0,0 +1,148 @@
+"""
+Measures the number of requests and the wall time of metadata & ACL syncs against a local fake Metabase
+
+Runs each sync twice per scale: first against an empty instance (everything changes), then again
+(nothing changes). Requires mara-metabase and its dependencies to be installed, but no Metabase
+instance and no databases.
+
+Usage:
+
+    python benchmarks/benchmark_sync.py --latency 0.005 --scales 10x20x4,50x50x10 --users 100
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_metabase import FakeMetabase
+
+
+def synthetic_data_sets(number_of_tables: int, number_of_fields: int, number_of_metrics: int) -> list:
+    """Data sets with `number_of_fields` attributes and `number_of_metrics` metrics each"""
+    from mara_schema.data_set import DataSet
+    from mara_schema.entity import Entity
+    from mara_schema.metric import Aggregation
+
+    data_sets = []
+    for i in range(number_of_tables):
+        entity = Entity(name=f'Entity {i}', description=f'Entity {i}', schema_name='dim')
+        for j in range(number_of_fields):
+            entity.add_attribute(name=f'Attribute {j}', description=f'Attribute {j} of entity {i}',
+                                 column_name=f'attribute_{j}')
+        data_set = DataSet(entity=entity, name=f'Data set {i}')
+        for k in range(number_of_metrics):
+            if k < 2 or k % 2 == 0:
+                data_set.add_simple_metric(name=f'Metric {k}', description=f'Metric {k}',
+                                           aggregation=Aggregation.SUM, column_name=f'metric_{k}')
+            else:
+                data_set.add_composed_metric(name=f'Metric {k}', description=f'Metric {k}',
+                                             formula=f'([Metric 0] - [Metric 1]) / [Metric {k - 1}] * 100')
+        data_sets.append(data_set)
+    return data_sets
+
+
+def setup_fake_warehouse(fake: FakeMetabase, data_sets: list):
+    """Adds a database with a table for each data set (plus technical columns) to the fake Metabase"""
+    from mara_metabase import config, metadata
+    from mara_schema.metric import SimpleMetric
+
+    fake.add_database(config.metabase_data_db_name(), {
+        data_set.name: list(metadata._attributes_by_column(data_set).keys())
+                       + [metric.name for metric in data_set.metrics.values() if isinstance(metric, SimpleMetric)]
+                       + ['_technical_id', '_loaded_at']
+        for data_set in data_sets})
+
+
+def patch_mara_acl(data_sets: list, number_of_users: int, number_of_roles: int):
+    """Replaces reading users & permissions from the mara db with synthetic ones"""
+    import mara_acl.keys
+    import mara_acl.permissions
+    import mara_schema.config
+    from mara_metabase import acl, views
+
+    mara_schema.config.data_sets = lambda: data_sets
+    views.acl_resource.children = None  # re-created from the patched data sets
+
+    roles = [f'Role {i}' for i in range(number_of_roles)]
+    users = {f'user.{i}@example.com': roles[i % number_of_roles] for i in range(number_of_users)}
+    acl._mara_users_and_roles = lambda: (users, set(roles))
+
+    # each role can access every other data set
+    permissions = {i: (mara_acl.keys.user_key(role), mara_acl.keys.resource_key(resource))
+                   for i, (role, resource) in enumerate((role, resource) for role in roles
+                                                        for n, resource in enumerate(views.acl_resource.children)
+                                                        if n % 2 == roles.index(role) % 2)}
+    mara_acl.permissions.all_permissions = lambda: permissions
+
+
+def measure(fake: FakeMetabase, fn) -> (float, int):
+    """Runs `fn` and returns the wall time and the number of requests it made"""
+    requests_before = sum(fake.request_counts.values())
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fn()
+    return time.monotonic() - start, sum(fake.request_counts.values()) - requests_before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.005, help='Seconds per request of the fake Metabase')
+    parser.add_argument('--scales', default='10x20x4,50x50x10,200x100x20',
+                        help='Comma separated tables x fields x metrics')
+    parser.add_argument('--users', type=int, default=100, help='Number of users for the ACL sync')
+    parser.add_argument('--roles', type=int, default=5, help='Number of roles for the ACL sync')
+    parser.add_argument('--skip-acl', action='store_true', help='Only benchmark the metadata sync')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Use the asyncio variants of the syncs (requires aiohttp)')
+    args = parser.parse_args()
+
+    from mara_metabase import acl, catalog, config, metadata
+
+    config.session_token_cache_file = lambda: None
+
+    # there is no metadata db, fingerprints are kept in memory
+    fingerprints = {}
+    metadata._read_fingerprint = fingerprints.get
+    metadata._write_fingerprint = fingerprints.__setitem__
+
+    print(f'{"scale":<14} {"sync":<16} {"run":<6} {"seconds":>8} {"requests":>9}')
+    for scale in args.scales.split(','):
+        number_of_tables, number_of_fields, number_of_metrics = map(int, scale.split('x'))
+        data_sets = synthetic_data_sets(number_of_tables, number_of_fields, number_of_metrics)
+
+        fake = FakeMetabase(latency=args.latency)
+        setup_fake_warehouse(fake, data_sets)
+        url = fake.start()
+        config.internal_metabase_url = lambda: url
+        catalog.invalidate()
+
+        try:
+            for run in ['cold', 'warm', 'noop']:
+                # the warm run bypasses the fingerprint to measure the diffing of unchanged metadata
+                if args.use_async:
+                    seconds, requests = measure(fake, lambda: asyncio.run(metadata.update_metadata_async(
+                        {config.metabase_data_db_name(): data_sets}, force=run == 'warm')))
+                else:
+                    seconds, requests = measure(fake, lambda: metadata.update_metadata(
+                        {config.metabase_data_db_name(): data_sets}, force=run == 'warm'))
+                print(f'{scale:<14} {"update_metadata":<16} {run:<6} {seconds:8.2f} {requests:9}')
+
+            if not args.skip_acl:
+                patch_mara_acl(data_sets, args.users, args.roles)
+                for run in ['cold', 'warm']:
+                    seconds, requests = measure(fake, (lambda: asyncio.run(acl.sync_async())) if args.use_async
+                                                else acl.sync)
+                    print(f'{scale:<14} {"acl.sync":<16} {run:<6} {seconds:8.2f} {requests:9}')
+        finally:
+            fake.stop()
+
+
+if __name__ == '__main__':
+    main()
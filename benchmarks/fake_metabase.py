@@ -0,0 +1,254 @@
+"""
+A local stand-in for the parts of the Metabase api that are used by mara_metabase
+
+Keeps all state in memory and answers each request after a configurable latency, so that the number
+of round trips of a sync and their cost can be measured without a Metabase instance.
+"""
+
+import collections
+import http.server
+import json
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+
+
+def _stored_mbql(mbql):
+    """Like Metabase >= 0.39, returns field references as `['field', id, None]` regardless of how they were sent"""
+    if isinstance(mbql, dict):
+        return {key: _stored_mbql(value) for key, value in mbql.items()}
+    if isinstance(mbql, list):
+        if len(mbql) == 2 and mbql[0] == 'field-id':
+            return ['field', mbql[1], None]
+        return [_stored_mbql(value) for value in mbql]
+    return mbql
+
+
+class FakeMetabase:
+    def __init__(self, latency: float = 0.0):
+        """
+        The state of a fake Metabase instance
+
+        Args:
+            latency: Seconds to wait before answering each request
+        """
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.request_counts = collections.Counter()
+        self.next_id = 1000
+        self.databases = {}  # id -> database
+        self.tables = {}  # id -> table (including 'db_id' and 'fields')
+        self.fields = {}  # id -> field (the same objects as in the tables)
+        self.metrics = {}  # id -> metric
+        self.groups = {1: {'id': 1, 'name': 'All Users'}, 2: {'id': 2, 'name': 'Administrators'}}
+        self.users = {1: {'id': 1, 'email': 'admin@my-company.com', 'first_name': 'Admin', 'last_name': 'Admin',
+                          'is_superuser': True, 'is_active': True, 'google_auth': False, 'group_ids': [1, 2]}}
+        self.graph = {'revision': 1, 'groups': {}}
+        self.server = None
+
+    def _id(self) -> int:
+        self.next_id += 1
+        return self.next_id
+
+    def add_database(self, name: str, tables: {str: [str]}, schema: str = 'metabase') -> int:
+        """Adds a database with tables (by name) and their column names"""
+        db_id = self._id()
+        self.databases[db_id] = {'id': db_id, 'name': name, 'engine': 'postgres', 'initial_sync_status': 'complete'}
+        for table_name, columns in tables.items():
+            table_id = self._id()
+            self.tables[table_id] = {
+                'id': table_id, 'db_id': db_id, 'name': table_name, 'schema': schema, 'description': None,
+                'visibility_type': None, 'show_in_getting_started': False, 'field_order': 'database',
+                'fields': [{'id': self._id(), 'table_id': table_id, 'name': column, 'description': None,
+                            'visibility_type': 'normal', 'has_field_values': 'list' if i % 3 == 0 else 'none'}
+                           for i, column in enumerate(columns)]}
+            self.fields.update((field['id'], field) for field in self.tables[table_id]['fields'])
+        return db_id
+
+    def start(self, port: int = 0) -> str:
+        """Starts the server in a background thread and returns its url"""
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                time.sleep(fake.latency)
+                status, result = fake.handle(self.command, self.path, body,
+                                             self.headers.get('X-Metabase-Session'))
+                data = json.dumps(result).encode('utf-8') if result is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method: str, path: str, body, session_id: str) -> (int, object):
+        """Answers a request with a (status code, json result)"""
+        url = urllib.parse.urlparse(path)
+        endpoint = re.sub(r'/\d+', '/{id}', url.path.rstrip('/'))
+        ids = [int(id) for id in re.findall(r'/(\d+)', url.path)]
+        with self.lock:
+            self.request_counts[f'{method} {endpoint}'] += 1
+            if endpoint == '/api/session' and method == 'POST':
+                return 200, {'id': 'fake-session'}
+            if session_id != 'fake-session':
+                return 401, 'Unauthenticated'
+            handler = getattr(self, _handler_name(method, endpoint), None)
+            if not handler:
+                return 404, f'{method} {endpoint} not implemented'
+            return handler(ids, body)
+
+    # databases & metadata
+
+    def get_api_database(self, ids, body):
+        return 200, list(self.databases.values())
+
+    def get_api_database_id(self, ids, body):
+        return 200, dict(self.databases[ids[0]],
+                         tables=[{key: value for key, value in table.items() if key != 'fields'}
+                                 for table in self.tables.values() if table['db_id'] == ids[0]])
+
+    def get_api_database_id_fields(self, ids, body):
+        return 200, [{'id': field['id'], 'name': field['name'], 'table_name': table['name'],
+                      'schema': table['schema']}
+                     for table in self.tables.values() if table['db_id'] == ids[0] for field in table['fields']]
+
+    def post_api_database_id_sync_schema(self, ids, body):
+        return 200, {'status': 'ok'}
+
+    def post_api_database_id_discard_values(self, ids, body):
+        return 200, {'status': 'ok'}
+
+    def post_api_database_id_rescan_values(self, ids, body):
+        return 200, {'status': 'ok'}
+
+    def get_api_database_id_metadata(self, ids, body):
+        database = dict(self.databases[ids[0]])
+        database['tables'] = [dict(table, metrics=[metric for metric in self.metrics.values()
+                                                   if metric['table_id'] == table['id']
+                                                   and not metric.get('archived')])
+                              for table in self.tables.values() if table['db_id'] == ids[0]]
+        return 200, json.loads(json.dumps(database))
+
+    def get_api_table(self, ids, body):
+        return 200, [{key: value for key, value in table.items() if key != 'fields'}
+                     for table in self.tables.values()]
+
+    def get_api_table_id_query_metadata(self, ids, body):
+        table = self.tables[ids[0]]
+        return 200, dict(json.loads(json.dumps(table)),
+                         metrics=[metric for metric in self.metrics.values()
+                                  if metric['table_id'] == table['id'] and not metric.get('archived')])
+
+    def put_api_table_id(self, ids, body):
+        self.tables[ids[0]].update(body)
+        return 200, {key: value for key, value in self.tables[ids[0]].items() if key != 'fields'}
+
+    def put_api_field_id(self, ids, body):
+        field = self.fields[ids[0]]
+        field.update(body)
+        return 200, field
+
+    def post_api_field_id_discard_values(self, ids, body):
+        return 200, {'status': 'success'}
+
+    def post_api_field_id_rescan_values(self, ids, body):
+        return 200, {'status': 'success'}
+
+    def get_api_metric(self, ids, body):
+        return 200, list(self.metrics.values())
+
+    def post_api_metric(self, ids, body):
+        metric = dict(body, id=self._id(), archived=False)
+        metric.pop('revision_message', None)
+        metric['definition'] = _stored_mbql(metric.get('definition'))
+        self.metrics[metric['id']] = metric
+        return 200, metric
+
+    def put_api_metric_id(self, ids, body):
+        body = dict(body)
+        body.pop('revision_message', None)
+        if 'definition' in body:
+            body['definition'] = _stored_mbql(body['definition'])
+        self.metrics[ids[0]].update(body)
+        return 200, self.metrics[ids[0]]
+
+    # users, groups & permissions
+
+    def get_api_user(self, ids, body):
+        return 200, {'data': list(self.users.values()), 'total': len(self.users)}
+
+    def post_api_user(self, ids, body):
+        user = {'id': self._id(), 'email': body['email'], 'first_name': body['first_name'],
+                'last_name': body['last_name'], 'is_superuser': bool(body.get('is_super_user')),
+                'google_auth': bool(body.get('google_auth')), 'is_active': True,
+                'group_ids': list(body.get('group_ids', []))}
+        self.users[user['id']] = user
+        return 200, user
+
+    def put_api_user_id(self, ids, body):
+        user = self.users[ids[0]]
+        user.update({key: value for key, value in body.items()
+                     if key in ('email', 'first_name', 'last_name', 'google_auth', 'group_ids')})
+        user['is_superuser'] = bool(body.get('is_super_user', user['is_superuser']))
+        return 200, user
+
+    def put_api_user_id_reactivate(self, ids, body):
+        self.users[ids[0]]['is_active'] = True
+        return 200, self.users[ids[0]]
+
+    def delete_api_user_id(self, ids, body):
+        self.users[ids[0]]['is_active'] = False
+        return 200, {'success': True}
+
+    def get_api_permissions_group(self, ids, body):
+        return 200, list(self.groups.values())
+
+    def post_api_permissions_group(self, ids, body):
+        group = {'id': self._id(), 'name': body['name']}
+        self.groups[group['id']] = group
+        return 200, group
+
+    def delete_api_permissions_group_id(self, ids, body):
+        self.groups.pop(ids[0], None)
+        self.graph['groups'].pop(str(ids[0]), None)
+        return 204, None
+
+    def get_api_permissions_graph(self, ids, body):
+        return 200, self.graph
+
+    def put_api_permissions_graph(self, ids, body):
+        if body['revision'] != self.graph['revision']:
+            return 409, 'Looks like someone else edited the permissions and your data is out of date.'
+        groups = json.loads(json.dumps(body['groups']))
+        for group_id, databases in groups.items():
+            self.graph['groups'].setdefault(group_id, {}).update(databases)
+        self.graph['revision'] += 1
+        return 200, self.graph
+
+
+def _handler_name(method: str, endpoint: str) -> str:
+    """e.g. 'PUT', '/api/field/{id}' -> 'put_api_field_id'"""
+    return (method.lower() + endpoint.replace('{id}', 'id')).replace('/', '_')
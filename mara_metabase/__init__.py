@@ -9,7 +9,7 @@ def MARA_FLASK_BLUEPRINTS():
 
 def MARA_CLICK_COMMANDS():
     from . import cli
-    return [cli.setup, cli.update_metadata, cli.sync_acl]
+    return [cli.setup, cli.update_metadata, cli.sync_acl, cli.export_metadata, cli.import_metadata]
 
 def MARA_ACL_RESOURCES():
     from .views import acl_resource
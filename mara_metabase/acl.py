@@ -1,97 +1,520 @@
 """Automatic syncing of users, groups and permissions from Mara to Metabase"""
 
+import typing as t
 
-def sync():
-    import mara_acl.keys
+from . import catalog, instrumentation
+
+if t.TYPE_CHECKING:
+    from .async_client import AsyncMetabaseClient
+    from .client import MetabaseApiError, MetabaseClient
+
+
+def sync(dry_run: bool = False) -> bool:
+    """
+    Reconciles all users, groups & permissions in Metabase with Mara ACL
+
+    Args:
+        dry_run: When True, only prints the changes that would be made (with read requests only)
+
+    Returns:
+        True when the sync succeeded (failed requests raise a `MetabaseApiError`)
+    """
+    from .client import MetabaseClient
+
+    client = MetabaseClient(dry_run=dry_run)
+
+    with instrumentation.phase('users & groups'):
+        # a full sync always starts from the current state in Metabase
+        catalog.invalidate()
+        metabase_groups = catalog.group_ids(client)
+        metabase_users = {user['email']: user for user in _list_users(client)}
+
+        mara_users, mara_roles = _mara_users_and_roles()
+
+        # add roles from mara that don't exist in metabase
+        for role in sorted(mara_roles - set(metabase_groups)):
+            metabase_groups[role] = create_group(client, role)
+
+        # reactivate users before they are updated
+        for requests in _user_requests(mara_users, metabase_users, metabase_groups, dry_run):
+            instrumentation.record_changes('users', len(requests))
+            for method, path, data in requests:
+                client.request(method, path, data)
+
+        cleanup_requests = _cleanup_requests(mara_users, mara_roles, metabase_users, metabase_groups)
+        instrumentation.record_changes('deletions', len(cleanup_requests))
+        for method, path, data in cleanup_requests:
+            client.request(method, path, data)
+
+    _update_permission_graph(client, metabase_groups)
+    return True
+
+
+async def sync_async(dry_run: bool = False) -> bool:
+    """
+    Like `sync`, but with an `AsyncMetabaseClient` so that it can run within an asyncio event loop (requires
+    aiohttp). The requests for all users & groups are sent concurrently, bounded by `config.http_pool_size()`.
+    """
+    import asyncio
+    from . import async_client
+
+    loop = asyncio.get_running_loop()  # for running blocking mara db queries in a thread
+
+    async with async_client.AsyncMetabaseClient(dry_run=dry_run) as client:
+        with instrumentation.phase('users & groups'):
+            catalog.invalidate()
+            metabase_groups, metabase_users, (mara_users, mara_roles) = await asyncio.gather(
+                catalog.group_ids_async(client), _list_users_async(client),
+                loop.run_in_executor(None, _mara_users_and_roles))
+            metabase_users = {user['email']: user for user in metabase_users}
+
+            new_roles = sorted(mara_roles - set(metabase_groups))
+            for role, group_id in zip(new_roles, await asyncio.gather(*[create_group_async(client, role)
+                                                                        for role in new_roles])):
+                metabase_groups[role] = group_id
+
+            for requests in _user_requests(mara_users, metabase_users, metabase_groups, dry_run):
+                instrumentation.record_changes('users', len(requests))
+                _raise_first_error(await async_client.execute_concurrently(client, requests))
+
+            cleanup_requests = _cleanup_requests(mara_users, mara_roles, metabase_users, metabase_groups)
+            instrumentation.record_changes('deletions', len(cleanup_requests))
+            _raise_first_error(await async_client.execute_concurrently(client, cleanup_requests))
+
+        with instrumentation.phase('permission graph'):
+            database_id = await catalog.database_id_async(client)
+            tables = await catalog.tables_async(client, database_id)
+            desired_permissions = _desired_permissions(metabase_groups, database_id, tables)
+            await put_permission_graph_changes_async(client, metabase_groups, desired_permissions,
+                                                     {database_id: tables})
+    return True
+
+
+def sync_user(email: str):
+    """Creates, updates or deletes a single user (and its group) in Metabase after a change in Mara ACL"""
     import mara_db.postgresql
-    from mara_acl import permissions
+
     from . import config
-    from . import views
+    from .client import MetabaseClient
+
+    if email == 'guest@localhost':
+        return
+
+    client = MetabaseClient()
+
+    with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
+        cursor.execute('SELECT role FROM acl_user WHERE email = %s', (email,))
+        row = cursor.fetchone()
+    role = row[0] if row else None
+
+    metabase_user = _find_user(client, email)
+
+    if not role:
+        # like in full syncs, the admin user (that the api is used with) is never deactivated
+        if metabase_user and metabase_user['is_active'] and email != config.metabase_admin_email():
+            client.delete(f'/api/user/{metabase_user["id"]}')
+        return
+
+    metabase_groups = catalog.group_ids(client)
+    new_group = role not in metabase_groups
+    if new_group:
+        metabase_groups[role] = create_group(client, role)
+
+    user = _metabase_user(email, role, metabase_groups)
+    if not metabase_user:
+        client.post('/api/user', user)
+    else:
+        if not metabase_user['is_active']:
+            client.put(f'/api/user/{metabase_user["id"]}/reactivate', user)
+        if _user_diff(metabase_user, user):
+            client.put(f'/api/user/{metabase_user["id"]}', user)
+
+    if new_group:
+        # a new group needs permissions for the data sets that the role can access
+        _update_permission_graph(client, metabase_groups)
+
+
+def sync_permissions():
+    """Rebuilds the Metabase permission graph after a change of permissions in Mara ACL"""
+    import mara_db.postgresql
 
     from .client import MetabaseClient
 
     client = MetabaseClient()
 
-    metabase_groups = {group['name']: group['id'] for group in client.get('/api/permissions/group')}
-    metabase_users = {user['email']: user['id'] for user in client.get('/api/user?include_deactivated=true')}
-    deactivated_metabase_users = {user['email']: user['id'] for user
-                                  in client.get('/api/user?include_deactivated=true') if not user['is_active']}
-    mara_roles = set()
-    mara_users = set()
+    metabase_groups = catalog.group_ids(client)
+    with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
+        cursor.execute('SELECT DISTINCT role FROM acl_user')
+        for role, in cursor.fetchall():
+            if role not in metabase_groups:
+                metabase_groups[role] = create_group(client, role)
 
-    # add roles and users from mara that don't exist in metabase
+    _update_permission_graph(client, metabase_groups)
+
+
+def _mara_users_and_roles() -> ({str: str}, {str}):
+    """The role of each Mara ACL user (except the guest user) and all roles"""
+    import mara_db.postgresql
+
+    mara_users = {}
+    mara_roles = set()
     with mara_db.postgresql.postgres_cursor_context('mara') as cursor:
-        cursor.execute('SELECT role, array_agg(email) FROM acl_user GROUP BY role')
-        for role, emails in cursor.fetchall():
+        cursor.execute('SELECT email, role FROM acl_user')
+        for email, role in cursor.fetchall():
             mara_roles.add(role)
-            if role not in metabase_groups:
-                result = client.post('/api/permissions/group', {'name': role})
-                metabase_groups[result['name']] = result['id']
-            for email in emails:
-                if email != 'guest@localhost':
-                    mara_users.add(email)
-                    first_name, last_name = email.replace('@', '.').split('.')[0:2]
-                    metabase_user = {'email': email,
-                                     'first_name': first_name.capitalize(),
-                                     'last_name': last_name.capitalize(),
-                                     'is_super_user': True if role == 'Administrators' else False,
-                                     'google_auth': True,
-                                     'group_ids': [metabase_groups[role], metabase_groups['All Users']]}
-                    if email not in metabase_users:
-                        print(client.post('/api/user', metabase_user))
-                    else:
-                        if email in deactivated_metabase_users:
-                            print(client.put(f'/api/user/{metabase_users[email]}/reactivate', metabase_user))
-                        print(client.put(f'/api/user/{metabase_users[email]}', metabase_user))
-
-    # delete groups that don't exist as roles in Mara
-    for group_name, id in metabase_groups.items():
+            if email != 'guest@localhost':
+                mara_users[email] = role
+    return mara_users, mara_roles
+
+
+def _metabase_user(email: str, role: str, metabase_groups: {str: int}) -> dict:
+    """The Metabase api representation of a Mara ACL user"""
+    first_name, last_name = email.replace('@', '.').split('.')[0:2]
+    return {'email': email,
+            'first_name': first_name.capitalize(),
+            'last_name': last_name.capitalize(),
+            'is_super_user': True if role == 'Administrators' else False,
+            'google_auth': True,
+            'group_ids': [metabase_groups[role], metabase_groups['All Users']]}
+
+
+def _list_users(client: 'MetabaseClient') -> [dict]:
+    """All active and deactivated Metabase users"""
+    users = client.get('/api/user?include_deactivated=true')
+    # newer Metabase versions return a paginated dict
+    return users['data'] if isinstance(users, dict) else users
+
+
+def _find_user(client: 'MetabaseClient', email: str) -> t.Optional[dict]:
+    """The active or deactivated Metabase user with an email address, or None"""
+    from urllib.parse import quote
+
+    # Metabase filters users by name & email with `query` (versions that don't support it return all users)
+    users = client.get(f'/api/user?include_deactivated=true&query={quote(email)}')
+    users = users['data'] if isinstance(users, dict) else users
+    return next((user for user in users if user['email'] == email), None)
+
+
+async def _list_users_async(client: 'AsyncMetabaseClient') -> [dict]:
+    users = await client.get('/api/user?include_deactivated=true')
+    return users['data'] if isinstance(users, dict) else users
+
+
+def _user_requests(mara_users: {str: str}, metabase_users: {str: dict}, metabase_groups: {str: int},
+                   dry_run: bool = False) -> [[(str, str, dict)]]:
+    """
+    The requests for creating, reactivating & updating Metabase users where needed
+
+    Returns:
+        Two batches of (method, path, data) requests: first the reactivations, then the creations & updates.
+        The requests within each batch can be sent concurrently.
+    """
+    reactivations = []
+    changes = []
+    for email, role in sorted(mara_users.items()):
+        desired_user = _metabase_user(email, role, metabase_groups)
+        metabase_user = metabase_users.get(email)
+        if not metabase_user:
+            changes.append(('POST', '/api/user', desired_user))
+        else:
+            if not metabase_user['is_active']:
+                reactivations.append(('PUT', f'/api/user/{metabase_user["id"]}/reactivate', desired_user))
+            diff = _user_diff(metabase_user, desired_user)
+            if diff:
+                if dry_run:
+                    print(f'.. {email}: ' + ', '.join(f'{key}: {old!r} -> {new!r}' for key, (old, new) in diff.items()))
+                changes.append(('PUT', f'/api/user/{metabase_user["id"]}', desired_user))
+    return [reactivations, changes]
+
+
+def _cleanup_requests(mara_users: {str: str}, mara_roles: {str}, metabase_users: {str: dict},
+                      metabase_groups: {str: int}) -> [(str, str, dict)]:
+    """
+    The requests for deleting groups that don't exist as roles in Mara and for deactivating users that
+    don't exist in Mara. Deleted groups are removed from `metabase_groups`.
+    """
+    from . import config
+
+    requests = []
+    for group_name, id in list(metabase_groups.items()):
         if group_name not in mara_roles and group_name not in ['All Users', 'Administrators']:
-            client.delete(f'/api/permissions/group/{id}')
+            requests.append(('DELETE', f'/api/permissions/group/{id}', None))
+            catalog.invalidate(('groups',))
+            del metabase_groups[group_name]
+
+    for email, metabase_user in metabase_users.items():
+        if (email not in mara_users and metabase_user['is_active']
+                and email != config.metabase_admin_email()):
+            requests.append(('DELETE', f'/api/user/{metabase_user["id"]}', None))
+    return requests
+
+
+def _raise_first_error(errors: [((str, str, dict), Exception)]):
+    """Prints all failed requests of a batch and raises the first error"""
+    if errors:
+        import sys
+        for (method, path, _), error in errors:
+            print(f'{method} {path} failed: {error}', file=sys.stderr)
+        raise errors[0][1]
+
+
+def _user_diff(metabase_user: dict, desired_user: dict) -> {str: tuple}:
+    """The attributes of an existing Metabase user that differ from `desired_user`, as {key: (current, desired)}"""
+    current = {'first_name': metabase_user.get('first_name'),
+               'last_name': metabase_user.get('last_name'),
+               'is_super_user': bool(metabase_user.get('is_superuser')),
+               'google_auth': bool(metabase_user.get('google_auth')),
+               # memberships are unknown in older Metabase versions
+               'group_ids': set(metabase_user['group_ids']) if 'group_ids' in metabase_user else None}
+    desired = {key: set(value) if key == 'group_ids' else value
+               for key, value in desired_user.items() if key in current}
+    return {key: (current[key], value) for key, value in desired.items() if current[key] != value}
+
 
-    for email, id in metabase_users.items():
-        if email not in mara_users and email != config.metabase_admin_email():
-            client.delete(f'/api/user/{id}')
+def create_group(client: 'MetabaseClient', name: str):
+    """Creates a group in Metabase and returns its id"""
+    result = client.post('/api/permissions/group', {'name': name})
+    catalog.invalidate(('groups',))
+    instrumentation.record_changes('groups', 1)
+    # in a dry run nothing is created, so the group can only be referenced by its name
+    return result['id'] if result else f'<{name}>'
 
-    # get current permissions
-    graph = client.get('/api/permissions/graph')
 
-    # create data set acl resources (the were not created when run through cli)
-    if not views.acl_resource.children:
-        views._create_acl_resource_for_each_data_set()
+async def create_group_async(client: 'AsyncMetabaseClient', name: str):
+    """Like `create_group`, with an async client"""
+    result = await client.post('/api/permissions/group', {'name': name})
+    catalog.invalidate(('groups',))
+    instrumentation.record_changes('groups', 1)
+    return result['id'] if result else f'<{name}>'
+
+
+@instrumentation.phase('permission graph')
+def _update_permission_graph(client: 'MetabaseClient', metabase_groups: {str: int}):
+    """
+    Gives each group access to the data set tables that the corresponding Mara ACL role can access
+
+    Only the groups & databases whose permissions changed are sent. When the graph was modified concurrently
+    (e.g. in the Metabase UI), the graph is fetched again and the changes are re-applied.
+    """
+    # all tables of the data warehouse
+    database_id = catalog.database_id(client)
+    tables = catalog.tables(client, database_id)
+    desired_permissions = _desired_permissions(metabase_groups, database_id, tables)
+    put_permission_graph_changes(client, metabase_groups, desired_permissions, {database_id: tables})
+
+
+def put_permission_graph_changes(client: 'MetabaseClient', metabase_groups: {str: int},
+                                 desired_permissions: {int: {int: dict}}, tables: {int: {str: dict}}):
+    """
+    Sends the groups & databases of `desired_permissions` that differ from the current permission graph
+
+    The changed groups are counted as 'permissions' in `instrumentation.record_changes`.
+
+    Args:
+        metabase_groups: The ids of all groups by name
+        desired_permissions: The permissions of each group by database id
+        tables: The tables of each database by name, as {'id': .., 'schema': ..} (e.g. from `catalog.tables`)
+    """
+    from .client import MetabaseApiError
+
+    for attempt in range(1, _permission_graph_attempts + 1):
+        graph = client.get('/api/permissions/graph')
+        changes = _graph_changes(graph, desired_permissions, metabase_groups, tables)
+        if not changes:
+            return
+        try:
+            client.put('/api/permissions/graph', {'revision': graph['revision'], 'groups': changes})
+            instrumentation.record_changes('permissions', len(changes))
+            return
+        except MetabaseApiError as e:
+            _check_retry_after_conflict(e, attempt)
+
+
+async def put_permission_graph_changes_async(client: 'AsyncMetabaseClient', metabase_groups: {str: int},
+                                             desired_permissions: {int: {int: dict}}, tables: {int: {str: dict}}):
+    """Like `put_permission_graph_changes`, with an async client"""
+    from .client import MetabaseApiError
+
+    for attempt in range(1, _permission_graph_attempts + 1):
+        graph = await client.get('/api/permissions/graph')
+        changes = _graph_changes(graph, desired_permissions, metabase_groups, tables)
+        if not changes:
+            return
+        try:
+            await client.put('/api/permissions/graph', {'revision': graph['revision'], 'groups': changes})
+            instrumentation.record_changes('permissions', len(changes))
+            return
+        except MetabaseApiError as e:
+            _check_retry_after_conflict(e, attempt)
+
 
-    # all mara acl permissions
-    all_permissions = permissions.all_permissions()
+# how often changes to the permission graph are tried to be applied when it is modified concurrently
+_permission_graph_attempts = 3
 
-    # all tables known in Metabase
-    tables = {table['name']: table for table in client.get('/api/table')}
 
-    database_id = client.get('/api/database/')[0]['id']
+def _check_retry_after_conflict(error: 'MetabaseApiError', attempt: int):
+    """Re-raises errors other than a revision conflict (409) and the conflict of the last attempt"""
+    if error.status_code != 409 or attempt == _permission_graph_attempts:
+        raise error
+    print(f'.. Permission graph was modified concurrently, retrying ({attempt}/{_permission_graph_attempts - 1})')
 
-    # build and upload new permission graph
-    new_graph = {'groups': {}, 'revision': graph['revision']}
+
+def _desired_permissions(metabase_groups: {str: int}, database_id: int, tables: {str: dict}) -> {int: {int: dict}}:
+    """The desired permissions of each group by database (only for groups with access to data set tables)"""
+    import mara_acl.keys
+    from mara_acl import permissions
+    from . import views
+
+    # the names of all data set resources that each user key (role or user) can access
+    data_sets = {resource.name for resource in views.acl_resource.children}
+    allowed_resources = _allowed_resources(permissions.all_permissions().values(), views.acl_resource.children,
+                                           mara_acl.keys.resource_key)
+
+    desired_permissions = {}
     for metabase_group, group_id in metabase_groups.items():
-        table_permissions = {}
         if metabase_group == 'Administrators':
-            new_graph['groups'][group_id] = {database_id: {'native': 'write', 'schemas': 'all'}}
+            desired_permissions[group_id] = {database_id: {'native': 'write', 'schemas': 'all'}}
         elif metabase_group == 'All Users':
-            new_graph['groups'][group_id] = {database_id: {'native': 'none', 'schemas': 'none'}}
+            desired_permissions[group_id] = {database_id: {'native': 'none', 'schemas': 'none'}}
+        else:
+            allowed_for_group = allowed_resources.get(mara_acl.keys.user_key(metabase_group), set())
+            schema_permissions = _schema_permissions(tables, data_sets, allowed_for_group)
+            if schema_permissions:
+                desired_permissions[group_id] = {database_id: {'schemas': schema_permissions}}
+    return desired_permissions
+
+
+def _schema_permissions(tables: {str: dict}, data_sets: {str}, allowed: {str}) -> {str: t.Union[str, dict]}:
+    """
+    The access of a group to the data set tables in each schema
+
+    Args:
+        tables: All tables of the database by name, as {'id': .., 'schema': ..}
+        data_sets: The names of all data sets
+        allowed: The names of the data sets that the group can access
+
+    Returns:
+        For each schema with data set tables either 'all' or 'none' when that applies to all tables in the
+        schema, or otherwise a {table id: 'all' | 'none'} mapping
+    """
+    schemas = {}
+    unmanaged_schemas = set()  # schemas with tables that don't belong to a data set
+    for name, table in tables.items():
+        schema = table['schema'] or ''  # the graph uses '' for databases without schemas
+        if name in data_sets:
+            schemas.setdefault(schema, {})[table['id']] = 'all' if name in allowed else 'none'
+        else:
+            unmanaged_schemas.add(schema)
+
+    for schema, table_permissions in schemas.items():
+        # a grant on the schema would also apply to tables that don't belong to a data set
+        if schema not in unmanaged_schemas and len(set(table_permissions.values())) == 1:
+            schemas[schema] = next(iter(table_permissions.values()))
+    return schemas
+
+
+def _allowed_resources(all_permissions, resources, resource_key) -> {str: {str}}:
+    """
+    Builds an index of which resources each user key is allowed to access
+
+    Args:
+        all_permissions: (user key, resource key prefix) tuples as returned by `mara_acl.permissions.all_permissions`
+        resources: The data set acl resources
+        resource_key: A function that returns the key of a resource
+
+    Returns:
+        A mapping of user keys to the names of the resources they can access
+    """
+    resource_keys = [(resource.name, resource_key(resource)) for resource in resources]
+    index = {}
+    for permission in all_permissions:
+        allowed = index.setdefault(permission[0], set())
+        for name, key in resource_keys:
+            if key.startswith(permission[1]):
+                allowed.add(name)
+    return index
+
+
+def _graph_changes(graph: dict, desired_permissions: {int: {int: dict}},
+                   metabase_groups: {str: int}, tables: {int: {str: dict}}) -> {str: {str: dict}}:
+    """
+    The groups & databases in `desired_permissions` whose permissions differ from the current `graph`
+
+    Metabase collapses & expands the graph in its own way (e.g. 'none' for a whole database, or all tables of
+    a schema instead of 'all'), so both sides are compared by the permissions they effectively give on the
+    tables that the desired permissions are about. Prints the names of the changed groups (from `metabase_groups`).
+    """
+    import json
+
+    # the current graph comes from json, so all ids are strings
+    desired_permissions = json.loads(json.dumps(desired_permissions))
+    changes = {}
+    for group_id, databases in desired_permissions.items():
+        current_databases = graph['groups'].get(group_id, {})
+        for database_id, database_permissions in databases.items():
+            table_schemas = {str(table['id']): table['schema'] or ''
+                             for table in tables.get(int(database_id), {}).values()}
+            if (_effective_permissions(current_databases.get(database_id), database_permissions, table_schemas)
+                    != _effective_permissions(database_permissions, database_permissions, table_schemas)):
+                changes.setdefault(group_id, {})[database_id] = database_permissions
+
+    if changes:
+        group_names = {str(group_id): name for name, group_id in metabase_groups.items()}
+        print(f'.. Permissions changed for {", ".join(group_names.get(group_id, group_id) for group_id in changes)}')
+    else:
+        print('.. Permission graph unchanged')
+    return changes
+
+
+def _effective_permissions(database_permissions: t.Union[dict, str, None], desired: dict,
+                           table_schemas: {str: str}) -> dict:
+    """
+    The permissions that a part of the permission graph gives on the native query editor (only when it is
+    part of `desired`) and on each table that `desired` is about
+
+    Args:
+        database_permissions: The permissions of a group for a database in any form of the graph
+        desired: The desired permissions of the group for the database
+        table_schemas: The schema of each table id of the database
+    """
+    effective = {}
+    if 'native' in desired:
+        if isinstance(database_permissions, dict):
+            effective['native'] = database_permissions.get('native', 'none')
         else:
-            for resource in views.acl_resource.children:
-                allowed = any([permission[0] == mara_acl.keys.user_key(metabase_group)
-                               and (mara_acl.keys.resource_key(resource).startswith(permission[1]))
-                               for permission in all_permissions.values()])
-                table = tables.get(resource.name)
-                if table:
-                    schema = table['schema']
-                    if schema not in table_permissions:
-                        table_permissions[schema] = {}
-                    table_permissions[schema][table['id']] = 'all' if allowed else 'none'
+            effective['native'] = 'write' if database_permissions == 'all' else 'none'
+
+    desired_schemas = desired.get('schemas', 'none')
+    if isinstance(desired_schemas, dict):
+        tables = [(schema, table_id) for schema, table_permissions in desired_schemas.items()
+                  for table_id in (table_permissions if isinstance(table_permissions, dict)
+                                   else [table_id for table_id, table_schema in table_schemas.items()
+                                         if table_schema == schema])]
+    else:
+        tables = [(schema, table_id) for table_id, schema in table_schemas.items()]
+
+    if not tables and not isinstance(desired_schemas, dict):
+        # no tables known (yet), compare the permission on the whole database
+        effective['schemas'] = _table_permission(database_permissions, None, None)
+    for schema, table_id in tables:
+        effective[table_id] = _table_permission(database_permissions, schema, table_id)
+    return effective
+
 
-            if table_permissions:
-                new_graph['groups'][group_id] = {database_id: {'schemas': table_permissions}}
+def _table_permission(database_permissions: t.Union[dict, str, None], schema: str, table_id: str) -> str:
+    """The permission of a group on a table, from its permissions for the database in any form of the graph"""
+    import json
 
-    print(client.put('/api/permissions/graph', new_graph))
+    permission = database_permissions
+    if isinstance(permission, dict):
+        permission = permission.get('schemas', 'none')
+    if isinstance(permission, dict):
+        permission = permission.get(schema, 'none')
+    if isinstance(permission, dict):
+        permission = permission.get(str(table_id), 'none')
+    if isinstance(permission, dict):  # e.g. {'read': 'all', 'query': 'segmented'} for sandboxed tables
+        return json.dumps(permission, sort_keys=True)
+    return permission or 'none'
 
 
 def enable_automatic_sync_of_users_and_permissions_to_metabase():
@@ -99,10 +522,18 @@ def enable_automatic_sync_of_users_and_permissions_to_metabase():
     import mara_acl.users
     from mara_app.monkey_patch import wrap
     import flask
+    from markupsafe import Markup
+    from . import config, jobs
 
-    def sync_and_catch_errors():
+    def sync_and_catch_errors(sync_fn, *args):
+        if config.sync_acl_in_background():
+            jobs.enqueue(' '.join([sync_fn.__name__, *args]), sync_fn, *args)
+            flask.flash(Markup(f'Syncing to Metabase in the background, see '
+                               f'<a href="{flask.url_for("mara_metabase.sync_status")}">sync status</a>'),
+                        category='info')
+            return
         try:
-            sync()
+            sync_fn(*args)
         except Exception as e:
             import traceback
             flask.flash(f'Error while syncing to Metabase: {e}', category='danger')
@@ -111,19 +542,19 @@ def enable_automatic_sync_of_users_and_permissions_to_metabase():
     @wrap(mara_acl.permissions.save_permissions)
     def save_permission(original_fn, permissions):
         original_fn(permissions)
-        sync_and_catch_errors()
+        sync_and_catch_errors(sync_permissions)
 
     @wrap(mara_acl.users.add_user)
     def add_user(original_fn, email: str, role: str):
         original_fn(email, role)
-        sync_and_catch_errors()
+        sync_and_catch_errors(sync_user, email)
 
     @wrap(mara_acl.users.delete_user)
     def delete_user(original_fn, email):
         original_fn(email)
-        sync_and_catch_errors()
+        sync_and_catch_errors(sync_user, email)
 
     @wrap(mara_acl.users.change_role)
     def change_role(original_fn, email, new_role):
         original_fn(email, new_role)
-        sync_and_catch_errors()
+        sync_and_catch_errors(sync_user, email)
@@ -0,0 +1,167 @@
+"""
+An asyncio variant of the Metabase client, for running syncs within asyncio services
+
+Requires the optional aiohttp dependency (`pip install mara-metabase[async]`).
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+from . import config, instrumentation
+from .client import MetabaseApiError, _read_cached_session_id, _write_cached_session_id, idempotent_methods
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMetabaseClient(object):
+    def __init__(self, dry_run: bool = False, max_concurrency: int = None):
+        """
+        A client for interacting with the Metabase api from asyncio code, to be used as an async context manager:
+
+            async with AsyncMetabaseClient() as client:
+                databases = await client.get('/api/database')
+
+        Args:
+            dry_run: When True, only GET requests are sent. All other requests are printed, recorded
+                     in `planned_writes` and return None.
+            max_concurrency: How many requests are in flight at most, defaults to `config.http_pool_size()`
+        """
+        self.metabase_url = config.internal_metabase_url()
+        self.session_id = None
+        self.dry_run = dry_run
+        self.planned_writes = []
+        self.max_concurrency = max_concurrency or config.http_pool_size()
+        self.session = None
+        self._semaphore = None
+        self._login_lock = None
+
+    async def __aenter__(self) -> 'AsyncMetabaseClient':
+        import aiohttp
+
+        # created here so that they are bound to the running event loop
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._login_lock = asyncio.Lock()
+        connect_timeout, read_timeout = config.http_timeout()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=config.http_pool_size()),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout))
+        try:
+            await self.login(use_cache=True)
+        except BaseException:
+            await self.session.close()
+            raise
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+
+    async def login(self, use_cache: bool = False):
+        """Logs in with the admin credentials, or reuses a session token from the cache file"""
+        session_id = _read_cached_session_id(self.metabase_url) if use_cache else None
+
+        if not session_id:
+            with instrumentation.phase('login'):
+                status, text = await self._send('POST', '/api/session',
+                                                {'username': config.metabase_admin_email(),
+                                                 'password': config.metabase_admin_password()})
+            if status != 200:
+                raise MetabaseApiError(status, text)
+            session_id = json.loads(text)['id']
+            _write_cached_session_id(self.metabase_url, session_id)
+
+        self.session_id = session_id
+
+    async def request(self, method: str, path: str, data=None):
+        if self.dry_run and method != 'GET':
+            print(f'would {method.lower()} {self.metabase_url + path} {json.dumps(data) if data else ""}')
+            self.planned_writes.append((method, path, data))
+            instrumentation.record_planned_write(method, path)
+            return None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'{method.lower()} {self.metabase_url + path} {json.dumps(data) if data else ""}')
+
+        session_id = self.session_id
+        status, text = await self._send(method, path, data)
+        if status == 401:
+            # the (cached) session expired or was revoked, log in again unless another task already did
+            async with self._login_lock:
+                if self.session_id == session_id:
+                    await self.login()
+            status, text = await self._send(method, path, data)
+        if status < 200 or status >= 300:
+            raise MetabaseApiError(status, text)
+        elif text:
+            return json.loads(text)
+        else:
+            return None
+
+    async def _send(self, method: str, path: str, data=None) -> (int, str):
+        """
+        Sends a request (at most `max_concurrency` at the same time) and records its statistics
+
+        Like the blocking client, retries with exponential backoff on connection errors, and for idempotent
+        requests also on read errors and 5xx responses. POST requests are additionally only retried after
+        429 responses, which means that the request was not processed.
+        """
+        import aiohttp
+
+        body = json.dumps(data).encode('utf-8') if data is not None else None
+        headers = {'Content-Type': 'application/json'}
+        if self.session_id:
+            headers['X-Metabase-Session'] = self.session_id
+
+        retries = 0
+        while True:
+            async with self._semaphore:
+                start = time.monotonic()
+                try:
+                    async with self.session.request(method, self.metabase_url + path,
+                                                    data=body, headers=headers) as response:
+                        status, text = response.status, await response.text()
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    if retries >= config.http_max_retries() or not (
+                            method in idempotent_methods or isinstance(e, aiohttp.ClientConnectorError)):
+                        raise
+                    status, text = None, None
+                else:
+                    instrumentation.record_request(method, path, status, time.monotonic() - start,
+                                                   len(body or b''), len(text.encode('utf-8')))
+
+            retry_statuses = (None, 429, 500, 502, 503, 504) if method in idempotent_methods else (None, 429)
+            if status not in retry_statuses or retries >= config.http_max_retries():
+                return status, text
+            await asyncio.sleep(config.http_retry_backoff_factor() * (2 ** retries))
+            retries += 1
+
+    async def get(self, path) -> dict:
+        return await self.request('GET', path)
+
+    async def post(self, path, data=None) -> dict:
+        return await self.request('POST', path, data)
+
+    async def put(self, path, data=None) -> dict:
+        return await self.request('PUT', path, data)
+
+    async def delete(self, path, data=None) -> dict:
+        return await self.request('DELETE', path, data)
+
+
+async def execute_concurrently(client: AsyncMetabaseClient,
+                               calls: [(str, str, dict)]) -> [((str, str, dict), Exception)]:
+    """
+    Sends a list of requests at the same time (bounded by the concurrency of the client)
+
+    Returns:
+        A list of (call, exception) tuples for all calls that failed. Other calls are not aborted by a failure.
+    """
+
+    async def execute(call):
+        method, path, data = call
+        try:
+            await client.request(method, path, data)
+        except Exception as e:
+            return call, e
+
+    return [error for error in await asyncio.gather(*[execute(call) for call in calls]) if error]
@@ -0,0 +1,143 @@
+"""
+A process-level cache of the ids of databases, tables & groups in Metabase
+
+Shared by metadata & ACL syncs, so that incremental syncs after each permission change don't list the whole
+Metabase catalog again. Entries expire after `config.catalog_cache_ttl()` seconds and are invalidated
+explicitly when syncs create or delete objects.
+"""
+
+import threading
+import time
+import typing as t
+
+from . import config
+
+if t.TYPE_CHECKING:
+    from .async_client import AsyncMetabaseClient
+    from .client import MetabaseClient
+
+_lock = threading.Lock()
+_cache = {}  # key -> (time fetched, value)
+
+
+def database_ids(client: 'MetabaseClient') -> {str: int}:
+    """The ids of all Metabase databases by name"""
+    return _cached(('databases',), lambda: _database_index(client.get('/api/database/')))
+
+
+async def database_ids_async(client: 'AsyncMetabaseClient') -> {str: int}:
+    """Like `database_ids`, with an async client"""
+    return await _cached_async(('databases',), client, '/api/database/', _database_index)
+
+
+def database_id(client: 'MetabaseClient', name: str = None) -> int:
+    """The id of a Metabase database, by default of the data warehouse (`config.metabase_data_db_name()`)"""
+    name = name or config.metabase_data_db_name()
+    ids = database_ids(client)
+    if name not in ids:
+        invalidate(('databases',))
+        ids = database_ids(client)
+    return _database_id(ids, name)
+
+
+async def database_id_async(client: 'AsyncMetabaseClient', name: str = None) -> int:
+    """Like `database_id`, with an async client"""
+    name = name or config.metabase_data_db_name()
+    ids = await database_ids_async(client)
+    if name not in ids:
+        invalidate(('databases',))
+        ids = await database_ids_async(client)
+    return _database_id(ids, name)
+
+
+def tables(client: 'MetabaseClient', db_id: int) -> {str: dict}:
+    """The tables of a Metabase database by name, as {'id': .., 'schema': ..}"""
+    return _cached(('tables', db_id),
+                   lambda: _database_table_index(client.get(f'/api/database/{db_id}?include=tables')))
+
+
+async def tables_async(client: 'AsyncMetabaseClient', db_id: int) -> {str: dict}:
+    """Like `tables`, with an async client"""
+    return await _cached_async(('tables', db_id), client, f'/api/database/{db_id}?include=tables',
+                               _database_table_index)
+
+
+def set_tables(db_id: int, tables: [dict]):
+    """Replaces the cached tables of a database with a fresh listing (e.g. after a schema sync)"""
+    with _lock:
+        _cache[('tables', db_id)] = (time.monotonic(), _table_index(tables))
+
+
+def group_ids(client: 'MetabaseClient') -> {str: int}:
+    """The ids of all Metabase groups by name (a copy that can be modified)"""
+    return dict(_cached(('groups',), lambda: _group_index(client.get('/api/permissions/group'))))
+
+
+async def group_ids_async(client: 'AsyncMetabaseClient') -> {str: int}:
+    """Like `group_ids`, with an async client"""
+    return dict(await _cached_async(('groups',), client, '/api/permissions/group', _group_index))
+
+
+def invalidate(key: tuple = None):
+    """Removes an entry (e.g. `('groups',)` or `('tables', db_id)`) or, by default, everything from the cache"""
+    with _lock:
+        if key is None:
+            _cache.clear()
+        else:
+            _cache.pop(key, None)
+
+
+def _cached(key: tuple, fetch: t.Callable):
+    value = _lookup(key)
+    if value is None:
+        # fetched without holding the lock, concurrent misses might fetch twice
+        value = fetch()
+        _store(key, value)
+    return value
+
+
+async def _cached_async(key: tuple, client: 'AsyncMetabaseClient', path: str, index: t.Callable):
+    value = _lookup(key)
+    if value is None:
+        value = index(await client.get(path))
+        _store(key, value)
+    return value
+
+
+def _lookup(key: tuple):
+    """The cached value for a key, or None when it is not cached or expired"""
+    with _lock:
+        entry = _cache.get(key)
+        if entry and time.monotonic() - entry[0] < config.catalog_cache_ttl():
+            return entry[1]
+    return None
+
+
+def _store(key: tuple, value):
+    with _lock:
+        _cache[key] = (time.monotonic(), value)
+
+
+def _database_index(databases: t.Union[list, dict]) -> {str: int}:
+    # newer Metabase versions return a paginated dict
+    if isinstance(databases, dict):
+        databases = databases['data']
+    return {database['name']: database['id'] for database in databases}
+
+
+def _database_id(ids: {str: int}, name: str) -> int:
+    if name not in ids:
+        raise KeyError(f'Database {name} not found in Metabase')
+    return ids[name]
+
+
+def _database_table_index(database: dict) -> {str: dict}:
+    return _table_index(database['tables'])
+
+
+def _table_index(tables: [dict]) -> {str: dict}:
+    return {table['name']: {'id': table['id'], 'schema': table['schema']} for table in tables}
+
+
+def _group_index(groups: [dict]) -> {str: int}:
+    return {group['name']: group['id'] for group in groups}
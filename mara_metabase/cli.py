@@ -1,21 +1,90 @@
+import functools
+import sys
+
 import click
 
+# the exit code of a dry run that found changes (1 is used for failures and 2 by click for usage errors)
+changes_pending_exit_code = 3
+
+
+def _instrumented(fn):
+    """
+    Adds a --verbose flag to a command and prints request & phase statistics after it ran
+
+    Exits with 1 when the command returns False, and with `changes_pending_exit_code` when a dry run
+    found objects that would be changed (requests that don't change objects, e.g. for triggering a
+    schema sync, are not counted).
+    """
+    @click.option('--verbose', default=False, is_flag=True, help='Print each request to the Metabase api.')
+    @functools.wraps(fn)
+    def wrapper(verbose: bool, **kwargs):
+        import logging
+        from . import instrumentation
+
+        if verbose:
+            logging.basicConfig(format='%(message)s')
+            logging.getLogger('mara_metabase').setLevel(logging.DEBUG)
+
+        instrumentation.reset()
+        try:
+            succeeded = fn(**kwargs)
+        finally:
+            print(instrumentation.summary())
+
+        if succeeded is False:
+            sys.exit(1)
+        if kwargs.get('dry_run') and instrumentation.changes():
+            sys.exit(changes_pending_exit_code)
+
+    return wrapper
+
 
 @click.command()
-def setup():
+@click.option('--dry-run', default=False, is_flag=True, help='Only print what would be changed.')
+@_instrumented
+def setup(dry_run: bool):
     """Configures the metabase instance"""
     from . import setup
-    setup.setup()
+    setup.setup(dry_run=dry_run)
 
 @click.command()
-def update_metadata():
+@click.option('--dry-run', default=False, is_flag=True, help='Only print what would be changed.')
+@click.option('--full-rescan', default=False, is_flag=True,
+              help='Rescan the values of all fields, not only of list fields & fields in changed tables.')
+@click.option('--force', default=False, is_flag=True,
+              help='Sync even when the metadata did not change since the last sync.')
+@_instrumented
+def update_metadata(dry_run: bool, full_rescan: bool, force: bool):
     """Sync schema definitions from Mara to Metabase"""
     from . import metadata
-    metadata.update_metadata()
+    return metadata.update_metadata(dry_run=dry_run, full_rescan=full_rescan, force=force)
 
 
 @click.command()
-def sync_acl():
+@click.option('--dry-run', default=False, is_flag=True, help='Only print what would be changed.')
+@_instrumented
+def sync_acl(dry_run: bool):
     """Syncs users, groups & data set permissions from mara to metabase"""
     from . import acl
-    acl.sync()
+    return acl.sync(dry_run=dry_run)
+
+
+@click.command()
+@click.option('--file', required=True, help='The snapshot file (gzip compressed when ending with .gz).')
+@click.option('--database', default=None, help='The Metabase database, defaults to the data warehouse.')
+@_instrumented
+def export_metadata(file: str, database: str):
+    """Writes the metadata & permissions of a Metabase database to a snapshot file"""
+    from . import snapshot
+    snapshot.export_snapshot(file, database)
+
+
+@click.command()
+@click.option('--file', required=True, help='A snapshot file written by export-metadata.')
+@click.option('--database', default=None, help='The Metabase database, defaults to the one of the snapshot.')
+@click.option('--dry-run', default=False, is_flag=True, help='Only print what would be changed.')
+@_instrumented
+def import_metadata(file: str, database: str, dry_run: bool):
+    """Applies a metadata & permissions snapshot to a Metabase database"""
+    from . import snapshot
+    return snapshot.import_snapshot(file, database, dry_run=dry_run)
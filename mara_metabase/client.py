@@ -1,44 +1,194 @@
 
-import requests
 import json
+import logging
+import os
+import threading
+import time
+
+import requests
+import requests.adapters
+
+from urllib3.util.retry import Retry
+
+from . import config, instrumentation
+
+logger = logging.getLogger(__name__)
+
+
+class MetabaseApiError(Exception):
+    def __init__(self, status_code: int, text: str):
+        """A non-successful response of the Metabase api"""
+        super().__init__(f'{status_code}: {text}')
+        self.status_code = status_code
 
-from . import config
 
 class MetabaseClient(object):
-    def __init__(self):
-        """A client for interacting with the Metabase api"""
+    def __init__(self, dry_run: bool = False):
+        """
+        A client for interacting with the Metabase api
+
+        Args:
+            dry_run: When True, only GET requests are sent. All other requests are printed, recorded
+                     in `planned_writes` and return None.
+        """
         self.metabase_url=config.internal_metabase_url()
         self.session_id = None
+        self.dry_run = dry_run
+        self.planned_writes = []
+        self.session = _create_session()
+        self._login_lock = threading.Lock()
+        self.login(use_cache=True)
 
-        response = requests.post(
-            self.metabase_url + '/api/session',
-            json={'username': config.metabase_admin_email(),
-                  'password': config.metabase_admin_password()})
+    def login(self, use_cache: bool = False):
+        """Gets a session token, either from the session token cache or with a new login"""
+        session_id = _read_cached_session_id(self.metabase_url) if use_cache else None
 
-        if response.status_code == 200:
-            self.session_id = response.json()['id']
-        else:
-            raise Exception(f'{response.status_code}: {response.text}')
+        if not session_id:
+            with instrumentation.phase('login'):
+                response = self._send('POST', '/api/session',
+                                      {'username': config.metabase_admin_email(),
+                                       'password': config.metabase_admin_password()})
 
+            if response.status_code == 200:
+                session_id = response.json()['id']
+                _write_cached_session_id(self.metabase_url, session_id)
+            else:
+                raise MetabaseApiError(response.status_code, response.text)
 
-    def request(self, method, path, data = None):
-        print(f'{method.__name__} {self.metabase_url + path} {json.dumps(data) if data else ""}')
-        response = method(self.metabase_url + path, headers={'X-Metabase-Session': self.session_id}, json=data)
+        self.session_id = session_id
+        self.session.headers['X-Metabase-Session'] = self.session_id
+
+    def request(self, method: str, path: str, data = None):
+        if self.dry_run and method != 'GET':
+            print(f'would {method.lower()} {self.metabase_url + path} {json.dumps(data) if data else ""}')
+            self.planned_writes.append((method, path, data))
+            instrumentation.record_planned_write(method, path)
+            return None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'{method.lower()} {self.metabase_url + path} {json.dumps(data) if data else ""}')
+        session_id = self.session_id
+        response = self._send(method, path, data)
+        if response.status_code == 401:
+            # the (cached) session expired or was revoked, log in again unless another thread already did
+            with self._login_lock:
+                if self.session_id == session_id:
+                    self.login()
+            response = self._send(method, path, data)
         if response.status_code < 200 or response.status_code >= 300:
-            raise Exception(f'{response.status_code}: {response.text}')
+            raise MetabaseApiError(response.status_code, response.text)
         elif response.text:
             return response.json()
         else:
             return None
 
+    def _send(self, method: str, path: str, data = None) -> requests.Response:
+        """Sends a request and records its statistics"""
+        start = time.monotonic()
+        response = self.session.request(method, self.metabase_url + path, json=data, timeout=config.http_timeout())
+        instrumentation.record_request(method, path, response.status_code, time.monotonic() - start,
+                                       len(response.request.body or b''), len(response.content))
+        return response
+
     def get(self, path) -> dict:
-        return self.request(requests.get, path)
+        return self.request('GET', path)
 
     def post(self, path, data=None) -> dict:
-        return self.request(requests.post, path, data)
+        return self.request('POST', path, data)
 
     def put(self, path, data=None) -> dict:
-        return self.request(requests.put, path, data)
+        return self.request('PUT', path, data)
 
     def delete(self, path, data=None) -> dict:
-        return self.request(requests.delete, path, data)
+        return self.request('DELETE', path, data)
+
+
+def _read_cached_session_id(metabase_url: str) -> str:
+    """Returns a session token from the cache file when it is not too old and for the same instance & user"""
+    path = config.session_token_cache_file()
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (cached.get('url') == metabase_url and cached.get('email') == config.metabase_admin_email()
+            and time.time() - cached.get('created_at', 0) < config.session_token_max_age()):
+        return cached.get('id')
+    return None
+
+
+def _write_cached_session_id(metabase_url: str, session_id: str):
+    """Atomically stores a session token in the cache file, readable only by the current user"""
+    import tempfile
+
+    path = config.session_token_cache_file()
+    if not path:
+        return
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        # a new file with a random name (and mode 0600), so that no existing file or symlink is written to
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.session-', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'url': metabase_url, 'email': config.metabase_admin_email(),
+                       'id': session_id, 'created_at': time.time()}, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f'Could not cache Metabase session token in {path}: {e}')
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# requests that can be sent again after a 429/5xx response or a read timeout without creating duplicates.
+# A POST (e.g. of a metric or group) might have been processed by the server, so it is only retried
+# when the connection could not be established.
+idempotent_methods = frozenset(['GET', 'PUT', 'DELETE'])
+
+
+def _create_session() -> requests.Session:
+    """
+    A session with a pool of keep-alive connections that retries on connection errors, and for idempotent
+    requests also on read errors and 429/5xx responses
+    """
+    retry_args = dict(total=config.http_max_retries(),
+                      backoff_factor=config.http_retry_backoff_factor(),
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      raise_on_status=False)  # the last response is returned and turned into an exception by the client
+    try:
+        retry = Retry(allowed_methods=idempotent_methods, **retry_args)
+    except TypeError:  # urllib3 < 1.26
+        retry = Retry(method_whitelist=idempotent_methods, **retry_args)
+
+    adapter = requests.adapters.HTTPAdapter(pool_connections=config.http_pool_size(),
+                                            pool_maxsize=config.http_pool_size(),
+                                            max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def execute_concurrently(client: MetabaseClient, calls: [(str, str, dict)], max_workers: int) -> [((str, str, dict), Exception)]:
+    """
+    Sends a list of requests on a bounded thread pool
+
+    Args:
+        client: The client to use
+        calls: A list of (method, path, data) tuples
+        max_workers: How many requests are in flight at most
+
+    Returns:
+        A list of (call, exception) tuples for all calls that failed. Other calls are not aborted by a failure.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def execute(call):
+        method, path, data = call
+        try:
+            client.request(method, path, data)
+        except Exception as e:
+            return call, e
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return [error for error in executor.map(execute, calls) if error]
@@ -46,5 +46,85 @@ def metabase_data_db_name() -> str:
 
 
 def seconds_to_wait_for_schema_sync() -> int:
-    """How many seconds to wait after an (asynchronous) schema sync has been triggered"""
+    """How many seconds to wait at most for an (asynchronous) schema sync to make all data set fields available"""
+    return 60
+
+
+def http_pool_size() -> int:
+    """How many keep-alive connections to the Metabase API are kept open at most"""
+    return 10
+
+
+def http_timeout() -> (float, float):
+    """The (connect, read) timeouts in seconds for a single request to the Metabase API"""
+    return (5, 120)
+
+
+def http_max_retries() -> int:
+    """How often a request to the Metabase API is retried after connection errors or (except for POST requests,
+    which are not idempotent) after read timeouts and 429/5xx responses"""
     return 5
+
+
+def http_retry_backoff_factor() -> float:
+    """The exponential backoff between retries, the n-th retry waits `backoff_factor * 2 ** (n - 1)` seconds"""
+    return 0.5
+
+
+def metadata_sync_concurrency() -> int:
+    """How many field, table & metric updates are sent in parallel during a metadata sync (1 = sequentially),
+    shared by all databases that are synced at the same time. Should not be bigger than `http_pool_size`"""
+    return 8
+
+
+def session_token_cache_file() -> str:
+    """
+    A file in which the Metabase session token is shared between the processes of a user (None disables caching).
+    Its directory is created with access for the current user only.
+    """
+    import os, pathlib
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache'
+    return str(pathlib.Path(cache_dir) / 'mara-metabase' / 'session.json')
+
+
+def session_token_max_age() -> int:
+    """After how many seconds a cached session token is not used anymore (Metabase sessions expire after 14 days)"""
+    return 24 * 60 * 60
+
+
+def sync_acl_in_background() -> bool:
+    """Whether ACL changes are synced to Metabase in a background thread rather than within the web request"""
+    return True
+
+
+def seconds_to_coalesce_background_syncs() -> float:
+    """How long the background worker waits for further ACL changes before syncing them together"""
+    return 2
+
+
+def password_hashing_processes() -> int:
+    """How many processes are used for hashing user passwords in `setup.add_users` (None = number of cores)"""
+    return None
+
+
+def metadata_sync_backend() -> str:
+    """
+    How metadata updates are written to Metabase: 'api' (one request per field, table & metric) or 'sql'
+    (bulk updates in the Metabase metadata db, falls back to the api when the db schema is not supported)
+    """
+    return 'api'
+
+
+def catalog_cache_ttl() -> float:
+    """For how many seconds the ids of databases, tables & groups in Metabase are cached within a process"""
+    return 5 * 60
+
+
+def on_request(endpoint: str, status_code: int, seconds: float, bytes_sent: int, bytes_received: int):
+    """Called after each request to the Metabase api, patch to forward request metrics to a monitoring system"""
+    pass
+
+
+def on_phase(phase: str, seconds: float):
+    """Called after each phase of a sync (e.g. 'login', 'schema sync wait'), patch to forward timings"""
+    pass
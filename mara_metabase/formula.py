@@ -0,0 +1,115 @@
+"""A minimal parser for arithmetic metric formulas (+, -, *, / and parentheses)"""
+
+import re
+import typing as t
+
+_token_pattern = re.compile(r'\s*(?:(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)'
+                            r'|(?P<name>[A-Za-z_]\w*)'
+                            r'|(?P<operator>[-+*/()]))')
+
+
+def to_mbql(formula: str, resolve_name: t.Callable[[str], t.Any]) -> t.Union[list, int, float]:
+    """
+    Turns an arithmetic formula into a Metabase (MBQL) expression
+
+    The result has the same structure as the one that was previously derived from sympy's
+    `parse_expr(.., evaluate=False)`: chains of the same operator are flattened, `a - b` becomes
+    `['+', a, ['*', -1, b]]` and `a / b` becomes `['*', a, ['/', 1, b]]`. The only difference is the negation of
+    a parenthesized expression: `-(a + b)` stays `['*', -1, ['+', a, b]]`, while sympy multiplied it out
+    (and reordered the terms), which is equivalent.
+
+    Args:
+        formula: The formula, e.g. `(m0 - m1) / m2`
+        resolve_name: Returns the expression for a variable in the formula
+
+    Returns:
+        A nested list (or a number for constant formulas)
+    """
+    tokens = _tokenize(formula)
+    position, tree = _parse_sum(tokens, 0)
+    if position != len(tokens):
+        raise ValueError(f'Unexpected "{tokens[position][1]}" in formula "{formula}"')
+    return _render(tree, resolve_name)
+
+
+def _tokenize(formula: str) -> [(str, str)]:
+    tokens = []
+    position = 0
+    formula = formula.rstrip()
+    while position < len(formula):
+        match = _token_pattern.match(formula, position)
+        if not match:
+            raise ValueError(f'Invalid character "{formula[position]}" in formula "{formula}"')
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        position = match.end()
+    return tokens
+
+
+# The parse tree consists of numbers, ('name', x), ('negate', x), ('inverse', x) and ('+' | '*', [args]).
+# As in sympy, only the operands of binary operations are flattened, e.g. (a + b) + c -> ('+', [a, b, c]),
+# while the result of a unary minus is a separate multiplication.
+
+def _combine(operator: str, left, right) -> tuple:
+    args = []
+    for arg in (left, right):
+        if isinstance(arg, tuple) and arg[0] == operator:
+            args.extend(arg[1])
+        else:
+            args.append(arg)
+    return (operator, args)
+
+
+def _parse_sum(tokens, position):
+    position, tree = _parse_product(tokens, position)
+    while position < len(tokens) and tokens[position] in (('operator', '+'), ('operator', '-')):
+        operator = tokens[position][1]
+        position, right = _parse_product(tokens, position + 1)
+        tree = _combine('+', tree, right if operator == '+' else ('negate', right))
+    return position, tree
+
+
+def _parse_product(tokens, position):
+    position, tree = _parse_unary(tokens, position)
+    while position < len(tokens) and tokens[position] in (('operator', '*'), ('operator', '/')):
+        operator = tokens[position][1]
+        position, right = _parse_unary(tokens, position + 1)
+        tree = _combine('*', tree, right if operator == '*' else ('inverse', right))
+    return position, tree
+
+
+def _parse_unary(tokens, position):
+    if position < len(tokens) and tokens[position] == ('operator', '-'):
+        position, operand = _parse_unary(tokens, position + 1)
+        return position, -operand if isinstance(operand, (int, float)) else ('negate', operand)
+    if position < len(tokens) and tokens[position] == ('operator', '+'):
+        return _parse_unary(tokens, position + 1)
+    return _parse_atom(tokens, position)
+
+
+def _parse_atom(tokens, position):
+    if position >= len(tokens):
+        raise ValueError('Unexpected end of formula')
+    kind, value = tokens[position]
+    if kind == 'number':
+        return position + 1, int(value) if value.isdigit() else float(value)
+    if kind == 'name':
+        return position + 1, ('name', value)
+    if value == '(':
+        position, tree = _parse_sum(tokens, position + 1)
+        if position >= len(tokens) or tokens[position] != ('operator', ')'):
+            raise ValueError('Missing ")" in formula')
+        return position + 1, tree
+    raise ValueError(f'Unexpected "{value}" in formula')
+
+
+def _render(tree, resolve_name):
+    if isinstance(tree, (int, float)):
+        return tree
+    kind, value = tree
+    if kind in ('+', '*'):
+        return [kind, *[_render(arg, resolve_name) for arg in value]]
+    if kind == 'negate':
+        return ['*', -1, _render(value, resolve_name)]
+    if kind == 'inverse':
+        return ['/', 1, _render(value, resolve_name)]
+    return resolve_name(value)
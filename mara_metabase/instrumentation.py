@@ -0,0 +1,134 @@
+"""Request & phase statistics of syncs to Metabase"""
+
+import collections
+import contextlib
+import re
+import threading
+import time
+
+from . import config
+
+# upper bounds (in seconds) of the request latency histogram buckets
+latency_buckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')]
+
+
+class EndpointStats:
+    def __init__(self):
+        """Aggregated statistics of all requests to an endpoint"""
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.histogram = [0] * len(latency_buckets)
+
+
+_lock = threading.Lock()
+_endpoints = collections.defaultdict(EndpointStats)
+_phases = collections.OrderedDict()
+_planned_writes = collections.Counter()
+_changes = collections.Counter()
+
+
+def reset():
+    """Clears all collected statistics"""
+    with _lock:
+        _endpoints.clear()
+        _phases.clear()
+        _planned_writes.clear()
+        _changes.clear()
+
+
+def endpoint(method: str, path: str) -> str:
+    """Normalizes a request to an endpoint, e.g. `PUT /api/field/{id}`"""
+    return f'{method} ' + re.sub(r'/\d+', '/{id}', path.split('?')[0])
+
+
+def record_request(method: str, path: str, status_code: int, seconds: float, bytes_sent: int, bytes_received: int):
+    """Adds a finished request to the statistics and calls `config.on_request`"""
+    name = endpoint(method, path)
+    with _lock:
+        stats = _endpoints[name]
+        stats.count += 1
+        stats.errors += 1 if status_code < 200 or status_code >= 300 else 0
+        stats.seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+        stats.bytes_sent += bytes_sent
+        stats.bytes_received += bytes_received
+        stats.histogram[next(i for i, bound in enumerate(latency_buckets) if seconds <= bound)] += 1
+    config.on_request(name, status_code, seconds, bytes_sent, bytes_received)
+
+
+def record_planned_write(method: str, path: str):
+    """
+    Counts a request that was not sent because of a dry run
+
+    This includes requests that don't change objects (e.g. triggering a schema sync), see `record_changes`
+    """
+    with _lock:
+        _planned_writes[endpoint(method, path)] += 1
+
+
+def planned_writes() -> int:
+    """The number of requests that were not sent because of a dry run"""
+    with _lock:
+        return sum(_planned_writes.values())
+
+
+def record_changes(kind: str, count: int):
+    """Counts the objects of a kind (e.g. 'metadata' or 'users') that a sync changes, or would change in a dry run"""
+    if count:
+        with _lock:
+            _changes[kind] += count
+
+
+def changes() -> int:
+    """The number of objects that were changed, or would be changed in a dry run"""
+    with _lock:
+        return sum(_changes.values())
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """Measures the wall time of a phase of a sync (phases with the same name are added up)"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - start
+        with _lock:
+            _phases[name] = _phases.get(name, 0) + seconds
+        config.on_phase(name, seconds)
+
+
+def summary() -> str:
+    """A human readable summary of all collected statistics"""
+    with _lock:
+        lines = ['Phases:']
+        lines += [f'  {name:<30} {seconds:8.2f}s' for name, seconds in _phases.items()]
+        lines += ['Requests:',
+                  f'  {"endpoint":<50} {"count":>6} {"errors":>6} {"total":>8} {"mean":>7} {"max":>7} '
+                  f'{"sent":>9} {"received":>9}  latency histogram (<= ' + ', '.join(
+                      'inf' if bound == float('inf') else f'{bound:g}s' for bound in latency_buckets) + ')']
+        for name, stats in sorted(_endpoints.items(), key=lambda item: -item[1].seconds):
+            lines.append(f'  {name:<50} {stats.count:6} {stats.errors:6} {stats.seconds:7.2f}s '
+                         f'{stats.seconds / stats.count:6.3f}s {stats.max_seconds:6.3f}s '
+                         f'{_format_bytes(stats.bytes_sent):>9} {_format_bytes(stats.bytes_received):>9}  '
+                         + ' '.join(map(str, stats.histogram)))
+        total = sum(stats.count for stats in _endpoints.values())
+        lines.append(f'  {total} requests in total')
+        if _planned_writes:
+            lines.append(f'  {sum(_planned_writes.values())} requests not sent (dry run): '
+                         + ', '.join(f'{name} ({count})' for name, count in sorted(_planned_writes.items())))
+        if _changes:
+            lines.append('Changes: ' + ', '.join(f'{kind} ({count})' for kind, count in sorted(_changes.items())))
+        return '\n'.join(lines)
+
+
+def _format_bytes(number: int) -> str:
+    for unit in ['B', 'KB', 'MB']:
+        if number < 1024:
+            return f'{number:.0f}{unit}'
+        number /= 1024
+    return f'{number:.1f}GB'
@@ -0,0 +1,75 @@
+"""An in-process background worker for syncs to Metabase that coalesces bursts of changes"""
+
+import collections
+import datetime
+import threading
+import time
+import traceback
+import typing as t
+
+from . import config
+
+Job = collections.namedtuple('Job', ['description', 'fn', 'args'])
+Job.__doc__ = 'A unit of sync work. Jobs with the same description are considered identical'
+
+Result = collections.namedtuple('Result', ['descriptions', 'started_at', 'duration', 'error'])
+Result.__doc__ = 'The outcome of running one or more coalesced jobs (error is None on success)'
+
+_pending: t.List[Job] = []
+_results: t.Deque[Result] = collections.deque(maxlen=50)
+_running: t.Optional[t.List[str]] = None
+_condition = threading.Condition()
+_worker: t.Optional[threading.Thread] = None
+
+
+def enqueue(description: str, fn: t.Callable, *args):
+    """Schedules `fn(*args)` to run in the background worker, starting the worker if necessary"""
+    global _worker
+    with _condition:
+        if description not in (job.description for job in _pending):
+            _pending.append(Job(description, fn, args))
+        _condition.notify()
+        if not _worker or not _worker.is_alive():
+            _worker = threading.Thread(target=_work, name='mara-metabase-sync', daemon=True)
+            _worker.start()
+
+
+def status() -> (t.List[str], t.Optional[t.List[str]], t.List[Result]):
+    """Returns the descriptions of pending and running jobs and the most recent results (newest first)"""
+    with _condition:
+        return [job.description for job in _pending], _running, list(reversed(_results))
+
+
+def _work():
+    global _running
+    while True:
+        with _condition:
+            while not _pending:
+                _condition.wait()
+            # wait until no new jobs came in for a while
+            while True:
+                count = len(_pending)
+                _condition.wait(config.seconds_to_coalesce_background_syncs())
+                if len(_pending) == count:
+                    break
+            jobs = _pending[:]
+            _pending.clear()
+            _running = [job.description for job in jobs]
+
+        started_at = datetime.datetime.now()
+        start = time.monotonic()
+        error = None
+        try:
+            if len(jobs) == 1:
+                jobs[0].fn(*jobs[0].args)
+            else:
+                # several changes are reconciled with a single full sync
+                from . import acl
+                acl.sync()
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+
+        with _condition:
+            _results.append(Result([job.description for job in jobs], started_at, time.monotonic() - start, error))
+            _running = None
@@ -2,113 +2,680 @@ import sys
 import time
 import typing as t
 
-import mara_schema.config
-from mara_schema.metric import Metric, SimpleMetric, ComposedMetric, Aggregation
-from mara_schema.attribute import Attribute
-
-from . import config
-from .client import MetabaseClient
-
-
-def update_metadata() -> bool:
-    """Updates descriptions of tables & fields in Metabase, creates metrics and flushes field caches"""
-    client = MetabaseClient()
-    all_dbs = client.get('/api/database/')
-
-    # metabase changed the API response sometimes between 38 and 41...
-    if isinstance(all_dbs, dict):
-        all_dbs = all_dbs["data"]
-    dwh_db_id = None
-    for db in all_dbs:
-        if db['name'] == config.metabase_data_db_name():
-            dwh_db_id = db['id']
-            break
-
-    if not dwh_db_id:
-        print(f'Database {config.metabase_data_db_name()} not found in Metabase', file=sys.stderr)
+from . import catalog, config, instrumentation
+from .client import MetabaseClient, execute_concurrently
+
+if t.TYPE_CHECKING:  # mara_schema is only imported when metadata is actually synced
+    from mara_schema.attribute import Attribute
+    from .async_client import AsyncMetabaseClient
+    from mara_schema.data_set import DataSet
+    from mara_schema.metric import Metric, SimpleMetric, ComposedMetric
+
+
+def update_metadata(databases: t.Dict[str, t.List['DataSet']] = None, dry_run: bool = False,
+                    full_rescan: bool = False, force: bool = False) -> bool:
+    """
+    Updates descriptions of tables & fields in Metabase, creates metrics and flushes field caches
+
+    Args:
+        databases: A mapping of Metabase database names to the data sets in that database, all databases are
+                   synced in parallel. Defaults to all data sets in `config.metabase_data_db_name()`
+        dry_run: When True, only prints the changes that would be made (with read requests only)
+        full_rescan: When True, the field values of all fields in the database are rescanned, otherwise only
+                     the values of list fields and of all data set fields in tables with changed metadata
+        force: When True, databases are synced even when their metadata fingerprint did not change since
+               the last successful sync (implied by `full_rescan`)
+
+    Returns:
+        True when all databases were synced successfully
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if databases is None:
+        import mara_schema.config
+        databases = {config.metabase_data_db_name(): mara_schema.config.data_sets()}
+
+    client = MetabaseClient(dry_run=dry_run)
+    _metric_definitions.clear()
+
+    # all databases share the connection pool of the client, so they also share the request concurrency
+    concurrency = max(1, config.metadata_sync_concurrency() // max(1, len(databases)))
+
+    def update_database(db_name: str) -> (bool, float):
+        start = time.monotonic()
+        try:
+            db_id = catalog.database_id(client, db_name)
+        except KeyError as e:
+            print(e.args[0], file=sys.stderr)
+            return False, 0
+        try:
+            succeeded = update_database_metadata(client, db_id, databases[db_name],
+                                                 dry_run, full_rescan, force, concurrency)
+        except Exception:
+            import traceback
+            print(f'Error while syncing metadata of {db_name}:\n{traceback.format_exc()}', file=sys.stderr)
+            succeeded = False
+        return succeeded, time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, len(databases))) as executor:
+        results = dict(zip(databases.keys(), executor.map(update_database, databases.keys())))
+
+    return _report_database_results(results)
+
+
+async def update_metadata_async(databases: t.Dict[str, t.List['DataSet']] = None, dry_run: bool = False,
+                                full_rescan: bool = False, force: bool = False) -> bool:
+    """
+    Like `update_metadata`, but with an `AsyncMetabaseClient` so that it can run within an asyncio event loop
+    (requires aiohttp). All requests of a database sync are sent concurrently, bounded by `config.http_pool_size()`.
+    """
+    import asyncio
+    from .async_client import AsyncMetabaseClient
+
+    if databases is None:
+        import mara_schema.config
+        databases = {config.metabase_data_db_name(): mara_schema.config.data_sets()}
+
+    _metric_definitions.clear()
+
+    async with AsyncMetabaseClient(dry_run=dry_run) as client:
+        async def update_database(db_name: str) -> (bool, float):
+            start = time.monotonic()
+            try:
+                db_id = await catalog.database_id_async(client, db_name)
+            except KeyError as e:
+                print(e.args[0], file=sys.stderr)
+                return False, 0
+            try:
+                succeeded = await update_database_metadata_async(client, db_id, databases[db_name],
+                                                                 dry_run, full_rescan, force)
+            except Exception:
+                import traceback
+                print(f'Error while syncing metadata of {db_name}:\n{traceback.format_exc()}', file=sys.stderr)
+                succeeded = False
+            return succeeded, time.monotonic() - start
+
+        results = dict(zip(databases.keys(), await asyncio.gather(*[update_database(db_name)
+                                                                     for db_name in databases])))
+
+    return _report_database_results(results)
+
+
+def _report_database_results(results: {str: (bool, float)}) -> bool:
+    """Prints the outcome of the sync of each database and returns whether all succeeded"""
+    for db_name, (succeeded, seconds) in results.items():
+        print(f'.. {db_name}: {"succeeded" if succeeded else "failed"} after {seconds:.1f} seconds')
+
+    return all(succeeded for succeeded, _ in results.values())
+
+
+def update_database_metadata(client: MetabaseClient, dwh_db_id: int, data_sets: t.List['DataSet'],
+                             dry_run: bool = False, full_rescan: bool = False, force: bool = False,
+                             concurrency: int = None) -> bool:
+    """
+    Syncs the metadata of a single Metabase database, see `update_metadata`
+
+    Args:
+        concurrency: How many requests are in flight at most, defaults to `config.metadata_sync_concurrency()`
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    data_sets = {data_set.name: data_set for data_set in data_sets}
+    concurrency = max(1, concurrency or config.metadata_sync_concurrency())
+
+    if not (force or full_rescan):
+        with instrumentation.phase('fingerprint'):
+            fingerprint = metadata_fingerprint(client, dwh_db_id, data_sets)
+            if fingerprint and fingerprint == _read_fingerprint(dwh_db_id):
+                print(f'.. Metadata of database {dwh_db_id} unchanged since last sync, skipping')
+                return True
+
+    print(f'.. Triggering schema sync of database {dwh_db_id}')
+    client.post(f'/api/database/{dwh_db_id}/sync_schema')
+
+    if not dry_run:
+        wait_for_schema_sync(client, dwh_db_id, required_columns(data_sets))
+
+    use_sql_backend = False
+    if config.metadata_sync_backend() == 'sql' and not dry_run:
+        from . import metadata_db
+        use_sql_backend = metadata_db.is_supported()
+
+    writes = []
+    unchanged = 0
+
+    # fields with value lists (e.g. for filter dropdowns) and all fields of tables with changed metadata
+    fields_to_rescan = []
+
+    # the fields of the data set tables whose metadata was processed, for the fingerprint of this sync
+    synced_field_ids = set()
+
+    # the metadata of each table is fetched separately, and its writes are sent while further tables are fetched
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        with instrumentation.phase('table loop'):
+            tables = client.get(f'/api/database/{dwh_db_id}?include=tables')['tables']
+            catalog.set_tables(dwh_db_id, tables)
+            for table in _fetch_table_metadata(client, [table for table in tables if table['name'] in data_sets],
+                                               executor, concurrency):
+                table_writes, table_unchanged, table_fields_to_rescan = table_metadata_writes(
+                    table, data_sets[table['name']], dry_run)
+                writes += table_writes
+                unchanged += table_unchanged
+                fields_to_rescan += table_fields_to_rescan
+                synced_field_ids |= {field['id'] for field in table['fields']}
+                if not use_sql_backend:
+                    futures += [executor.submit(_execute, client, write) for write in table_writes]
+
+            hidden_table_writes, hidden_tables_unchanged = _hidden_table_writes(tables, data_sets)
+            writes += hidden_table_writes
+            unchanged += hidden_tables_unchanged
+            if not use_sql_backend:
+                futures += [executor.submit(_execute, client, write) for write in hidden_table_writes]
+
+        print(f'.. {"Would update" if dry_run else "Updating"} {len(writes)} objects ({unchanged} unchanged)')
+        instrumentation.record_changes('metadata', len(writes))
+        with instrumentation.phase('metadata writes'):
+            if use_sql_backend:
+                futures = [executor.submit(_execute, client, write) for write in metadata_db.apply_writes(writes)]
+            errors = [error for error in (future.result() for future in futures) if error]
+
+    with instrumentation.phase('field value rescan'):
+        if full_rescan:
+            print('.. Discarding field values')
+            client.post(f'/api/database/{dwh_db_id}/discard_values')
+
+            print('.. Rescanning field values')
+            client.post(f'/api/database/{dwh_db_id}/rescan_values')
+        elif fields_to_rescan:
+            print(f'.. Discarding & rescanning values of {len(fields_to_rescan)} fields')
+            for calls in _field_value_rescans(fields_to_rescan):
+                errors += execute_concurrently(client, calls, concurrency)
+
+    if errors:
+        report_errors(errors)
         return False
 
-    print('.. Triggering schema sync')
-    client.post(f'/api/database/{dwh_db_id}/sync_schema')
+    if not dry_run:
+        with instrumentation.phase('fingerprint'):
+            fingerprint = _synced_fingerprint(client.get(f'/api/database/{dwh_db_id}/fields'), tables,
+                                              synced_field_ids, data_sets)
+            if fingerprint:
+                _write_fingerprint(dwh_db_id, fingerprint)
 
-    seconds = config.seconds_to_wait_for_schema_sync()
-    print(f'.. Waiting {seconds} seconds')
-    time.sleep(seconds)
-
-    metadata = client.get(f'/api/database/{dwh_db_id}/metadata?include_hidden=true')
-    data_sets = {data_set.name: data_set for data_set in mara_schema.config.data_sets()}
-
-    for table in metadata['tables']:
-        data_set = data_sets.get(table['name'])
-        if data_set:
-            client.put(f'/api/table/{table["id"]}',
-                       {'description': metabase_description(data_set.entity),
-                        'show_in_getting_started': True,
-                        'field_order': 'database'})
-
-            _attributes = {}
-            for path, attributes in data_set.connected_attributes().items():
-                for name, attribute in attributes.items():
-                    _attributes[name] = attribute
-
-            for field in table['fields']:
-                attribute = _attributes.get(field['name'], None)
-                if attribute:
-                    # https://github.com/metabase/metabase/blob/master/frontend/src/metabase/meta/types/Field.js
-                    client.put(f'/api/field/{field["id"]}',
-                               {'description': metabase_description(attribute) or 'tbd',
-                                'visibility_type': 'normal',
-                                })
-                else:
-                    client.put(f'/api/field/{field["id"]}',
-                               {'description': '>> technical field hidden by schema sync',
-                                'visibility_type': 'sensitive'})
-
-            for name, _metric in data_set.metrics.items():
-                metric = {'name': name,
-                          'description': metabase_description(_metric),
-                          'table_id': table['id'],
-                          'definition': {'source-table': table['id'],
-                                         'aggregation': [
-                                             metabase_aggregation_definition(_metric, table)
-                                         ]},
-                          'show_in_getting_started': False,
-                          'how_is_this_calculated': _metric.display_formula(),
-                          'revision_message': 'Auto schema import'}
-
-                existing_metric = next(filter(lambda m: m['name'] == name, table['metrics']), None)
-                if existing_metric:
-                    client.put(f'/api/metric/{existing_metric["id"]}', metric)
-                else:
-                    client.post('/api/metric', metric)
-
-            for metric in table['metrics']:
-                if metric['name'] not in data_set.metrics:
-                    client.put(f'/api/metric/{metric["id"]}',
-                               {'archived': True, 'revision_message': 'Auto schema import'})
+    return True
 
-        else:
-            client.put(f'/api/table/{table["id"]}',
-                       {'visibility_type': 'hidden'})
 
-    print('.. Discarding field values')
-    client.post(f'/api/database/{dwh_db_id}/discard_values')
+async def update_database_metadata_async(client: 'AsyncMetabaseClient', dwh_db_id: int,
+                                         data_sets: t.List['DataSet'], dry_run: bool = False,
+                                         full_rescan: bool = False, force: bool = False) -> bool:
+    """Like `update_database_metadata`, with an async client"""
+    import asyncio
+    from . import async_client
+
+    loop = asyncio.get_running_loop()  # for running blocking metadata db queries in a thread
+    data_sets = {data_set.name: data_set for data_set in data_sets}
+
+    if not (force or full_rescan):
+        with instrumentation.phase('fingerprint'):
+            current_fingerprint = _fingerprint(await client.get(f'/api/database/{dwh_db_id}/fields'),
+                                               await catalog.tables_async(client, dwh_db_id), data_sets)
+            if current_fingerprint and current_fingerprint == await loop.run_in_executor(None, _read_fingerprint,
+                                                                                         dwh_db_id):
+                print(f'.. Metadata of database {dwh_db_id} unchanged since last sync, skipping')
+                return True
+
+    print(f'.. Triggering schema sync of database {dwh_db_id}')
+    await client.post(f'/api/database/{dwh_db_id}/sync_schema')
+
+    if not dry_run:
+        await wait_for_schema_sync_async(client, dwh_db_id, required_columns(data_sets))
+
+    use_sql_backend = False
+    if config.metadata_sync_backend() == 'sql' and not dry_run:
+        from . import metadata_db
+        use_sql_backend = await loop.run_in_executor(None, metadata_db.is_supported)
+
+    writes = []
+    unchanged = 0
+    fields_to_rescan = []
+    synced_field_ids = set()
+    errors = []
+
+    # like the table loop of the blocking sync, at most `metadata_sync_concurrency` tables are in flight
+    window = asyncio.Semaphore(max(1, config.metadata_sync_concurrency()))
+
+    async def sync_table(table_id: int):
+        """Fetches the metadata of a table and sends its writes"""
+        nonlocal unchanged
+        async with window:
+            table = await client.get(f'/api/table/{table_id}/query_metadata'
+                                     f'?include_sensitive_fields=true&include_hidden_fields=true')
+            table_writes, table_unchanged, table_fields_to_rescan = table_metadata_writes(
+                table, data_sets[table['name']], dry_run)
+            writes.extend(table_writes)
+            unchanged += table_unchanged
+            fields_to_rescan.extend(table_fields_to_rescan)
+            synced_field_ids.update(field['id'] for field in table['fields'])
+            if not use_sql_backend:
+                errors.extend(await async_client.execute_concurrently(client, table_writes))
+
+    with instrumentation.phase('table loop'):
+        tables = (await client.get(f'/api/database/{dwh_db_id}?include=tables'))['tables']
+        catalog.set_tables(dwh_db_id, tables)
+        hidden_table_writes, unchanged = _hidden_table_writes(tables, data_sets)
+        writes += hidden_table_writes
+        if not use_sql_backend:
+            errors += await async_client.execute_concurrently(client, hidden_table_writes)
+        await asyncio.gather(*[sync_table(table['id']) for table in tables if table['name'] in data_sets])
+
+    print(f'.. {"Would update" if dry_run else "Updating"} {len(writes)} objects ({unchanged} unchanged)')
+    instrumentation.record_changes('metadata', len(writes))
+    if use_sql_backend:
+        with instrumentation.phase('metadata writes'):
+            remaining_writes = await loop.run_in_executor(None, metadata_db.apply_writes, writes)
+            errors += await async_client.execute_concurrently(client, remaining_writes)
+
+    with instrumentation.phase('field value rescan'):
+        if full_rescan:
+            print('.. Discarding field values')
+            await client.post(f'/api/database/{dwh_db_id}/discard_values')
+
+            print('.. Rescanning field values')
+            await client.post(f'/api/database/{dwh_db_id}/rescan_values')
+        elif fields_to_rescan:
+            print(f'.. Discarding & rescanning values of {len(fields_to_rescan)} fields')
+            for calls in _field_value_rescans(fields_to_rescan):
+                errors += await async_client.execute_concurrently(client, calls)
+
+    if errors:
+        report_errors(errors)
+        return False
 
-    print('.. Rescanning field values')
-    client.post(f'/api/database/{dwh_db_id}/rescan_values')
+    if not dry_run:
+        with instrumentation.phase('fingerprint'):
+            current_fingerprint = _synced_fingerprint(await client.get(f'/api/database/{dwh_db_id}/fields'), tables,
+                                                      synced_field_ids, data_sets)
+            if current_fingerprint:
+                await loop.run_in_executor(None, _write_fingerprint, dwh_db_id, current_fingerprint)
 
     return True
 
 
+def _hidden_table_writes(tables: [dict], data_sets: {str: 'DataSet'}) -> ([(str, str, dict)], int):
+    """Requests for hiding the tables without a data set (for which the table listing is sufficient),
+    and the number of tables that are already hidden"""
+    writes = []
+    unchanged = 0
+    for table in tables:
+        if table['name'] not in data_sets:
+            if table.get('visibility_type') != 'hidden':
+                writes.append(('PUT', f'/api/table/{table["id"]}', {'visibility_type': 'hidden'}))
+            else:
+                unchanged += 1
+    return writes, unchanged
+
+
+def _field_value_rescans(field_ids: [int]) -> [[(str, str, None)]]:
+    """The requests for discarding and then rescanning the cached values of fields, as two consecutive batches"""
+    return [[('POST', f'/api/field/{field_id}/discard_values', None) for field_id in field_ids],
+            [('POST', f'/api/field/{field_id}/rescan_values', None) for field_id in field_ids]]
+
+
+def report_errors(errors: [((str, str, dict), Exception)]):
+    """Prints the failed requests of a sync to stderr"""
+    for (method, path, _), error in errors:
+        print(f'{method} {path} failed: {error}', file=sys.stderr)
+    print(f'{len(errors)} requests failed', file=sys.stderr)
+
+
+def metadata_fingerprint(client: MetabaseClient, db_id: int, data_sets: {str: 'DataSet'}) -> t.Optional[str]:
+    """
+    A hash over the desired metadata of all tables of a database (descriptions, visibility & compiled metrics)
+
+    Needs only a single light request: the field ids are taken from Metabase (and the table ids from the
+    catalog cache), everything else comes from the data sets. Returns None when columns of the data sets
+    are not yet known to Metabase, so that a sync is never skipped before Metabase has seen all columns.
+    """
+    return _fingerprint(client.get(f'/api/database/{db_id}/fields'), catalog.tables(client, db_id), data_sets)
+
+
+def _fingerprint(fields: [dict], tables: {str: dict}, data_sets: {str: 'DataSet'}) -> t.Optional[str]:
+    """Computes `metadata_fingerprint` from the fields & the (cached) tables of a database"""
+    import hashlib
+    import json
+
+    if _missing_columns(fields, data_sets):
+        return None
+
+    tables = {name: dict(table, fields=[]) for name, table in tables.items()}
+    for field in fields:
+        tables.get(field['table_name'], {'fields': []})['fields'].append({'id': field['id'], 'name': field['name']})
+
+    desired = {}
+    for name, table in sorted(tables.items()):
+        if name in data_sets:
+            # all requests that would be sent for a table without any metadata
+            writes, _, _ = table_metadata_writes({'id': table['id'], 'name': name, 'metrics': [],
+                                                  'fields': sorted(table['fields'], key=lambda f: f['id'])},
+                                                 data_sets[name])
+            desired[name] = writes
+        else:
+            desired[name] = table['id']
+
+    return hashlib.sha256(json.dumps(desired, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _synced_fingerprint(fields: [dict], tables: [dict], synced_field_ids: {int},
+                        data_sets: {str: 'DataSet'}) -> t.Optional[str]:
+    """
+    The fingerprint to store after a sync, from a fresh field list and the table listing that was processed
+
+    Returns None when the field list contains fields of data set tables that were not processed (e.g. added
+    by a still running schema sync of Metabase), so that they are not skipped by the next sync.
+    """
+    if any(field['id'] not in synced_field_ids for field in fields if field['table_name'] in data_sets):
+        return None
+    return _fingerprint(fields, {table['name']: table for table in tables}, data_sets)
+
+
+def _fingerprint_setting_key(db_id: int) -> str:
+    return f'mara-metabase-metadata-fingerprint-{db_id}'
+
+
+def _read_fingerprint(db_id: int) -> t.Optional[str]:
+    """The fingerprint of the last successful sync of a database, stored in the `setting` table of Metabase"""
+    import mara_db.postgresql
+
+    try:
+        with mara_db.postgresql.postgres_cursor_context(config.metabase_metadata_db_alias()) as cursor:
+            cursor.execute('SELECT value FROM setting WHERE key = %s', (_fingerprint_setting_key(db_id),))
+            row = cursor.fetchone()
+            return row[0] if row else None
+    except Exception as e:
+        print(f'Could not read metadata fingerprint: {e}', file=sys.stderr)
+        return None
+
+
+def _write_fingerprint(db_id: int, fingerprint: str):
+    import mara_db.postgresql
+
+    try:
+        with mara_db.postgresql.postgres_cursor_context(config.metabase_metadata_db_alias()) as cursor:
+            cursor.execute("""
+INSERT INTO setting (key, value)
+VALUES (%s, %s)
+ON CONFLICT (key) DO UPDATE
+    SET value = EXCLUDED.value""", (_fingerprint_setting_key(db_id), fingerprint))
+    except Exception as e:
+        print(f'Could not store metadata fingerprint: {e}', file=sys.stderr)
+
+
+def table_metadata_writes(table: dict, data_set: 'DataSet', dry_run: bool = False) -> ([(str, str, dict)], int, [int]):
+    """
+    Computes the requests that are needed to bring the metadata of a table in line with its data set
+
+    Args:
+        table: The table metadata as returned by `/api/table/:id/query_metadata`
+        data_set: The data set of the table
+        dry_run: When True, prints a diff for each change
+
+    Returns:
+        A list of (method, path, data) requests, the number of unchanged objects and the ids of the fields
+        whose values need to be rescanned
+    """
+    writes = []
+    unchanged = 0
+
+    def put_if_changed(path: str, current: dict, desired: dict):
+        """Schedules sending `desired` to `path` when it differs from what Metabase currently has"""
+        nonlocal unchanged
+        diff = _diff(current, desired)
+        if diff:
+            writes.append(('PUT', path, desired))
+            if dry_run:
+                print(f'.. {path} ({current.get("name", "")}): '
+                      + ', '.join(f'{key}: {_abbreviate(old)} -> {_abbreviate(new)}' for key, (old, new) in diff.items()))
+        else:
+            unchanged += 1
+
+    put_if_changed(f'/api/table/{table["id"]}', table,
+                   {'description': metabase_description(data_set.entity),
+                    'show_in_getting_started': True,
+                    'field_order': 'database'})
+
+    _attributes = _attributes_by_column(data_set)
+
+    for field in table['fields']:
+        attribute = _attributes.get(field['name'], None)
+        if attribute:
+            # https://github.com/metabase/metabase/blob/master/frontend/src/metabase/meta/types/Field.js
+            put_if_changed(f'/api/field/{field["id"]}', field,
+                           {'description': metabase_description(attribute) or 'tbd',
+                            'visibility_type': 'normal',
+                            })
+        else:
+            put_if_changed(f'/api/field/{field["id"]}', field,
+                           {'description': '>> technical field hidden by schema sync',
+                            'visibility_type': 'sensitive'})
+
+    # field values only need a rescan when the table or its fields changed, not for metric changes
+    table_changed = bool(writes)
+
+    for name, _metric in data_set.metrics.items():
+        metric = {'name': name,
+                  'description': metabase_description(_metric),
+                  'table_id': table['id'],
+                  'definition': {'source-table': table['id'],
+                                 'aggregation': [
+                                     metabase_aggregation_definition(_metric, table)
+                                 ]},
+                  'show_in_getting_started': False,
+                  'how_is_this_calculated': _metric.display_formula(),
+                  'revision_message': 'Auto schema import'}
+
+        existing_metric = next(filter(lambda m: m['name'] == name, table['metrics']), None)
+        if existing_metric:
+            put_if_changed(f'/api/metric/{existing_metric["id"]}', existing_metric, metric)
+        else:
+            writes.append(('POST', '/api/metric', metric))
+            if dry_run:
+                print(f'.. /api/metric: new metric {name} for table {table["name"]}')
+
+    for metric in table['metrics']:
+        if metric['name'] not in data_set.metrics:
+            put_if_changed(f'/api/metric/{metric["id"]}', metric,
+                           {'archived': True, 'revision_message': 'Auto schema import'})
+
+    # value lists can become stale with every load of the data warehouse, other field values only matter when
+    # the metadata of a table changed (hidden technical fields are never rescanned)
+    fields_to_rescan = [field['id'] for field in table['fields'] if field['name'] in _attributes
+                        and (table_changed or field.get('has_field_values') == 'list')]
+
+    return writes, unchanged, fields_to_rescan
+
+
+def _fetch_table_metadata(client: MetabaseClient, tables: [dict], executor, window: int) -> t.Iterator[dict]:
+    """
+    Yields the full metadata (with fields & metrics) of each table, in the order of `tables`
+
+    At most `window` tables are fetched ahead, so that only a few tables are in memory at the same time.
+    """
+    import collections
+
+    ahead = collections.deque()
+    for table in tables:
+        ahead.append(executor.submit(
+            client.get, f'/api/table/{table["id"]}/query_metadata?include_sensitive_fields=true&include_hidden_fields=true'))
+        if len(ahead) >= window:
+            yield ahead.popleft().result()
+    while ahead:
+        yield ahead.popleft().result()
+
+
+def _execute(client: MetabaseClient, call: (str, str, dict)) -> t.Optional[tuple]:
+    """Sends a (method, path, data) request and returns a (call, exception) tuple when it failed"""
+    method, path, data = call
+    try:
+        client.request(method, path, data)
+    except Exception as e:
+        return call, e
+
+
+@instrumentation.phase('schema sync wait')
+def wait_for_schema_sync(client: MetabaseClient, db_id: int, columns: {str}) -> [dict]:
+    """
+    Polls the field list of a database until Metabase knows all given columns and the schema sync settled
+
+    Waits at most `config.seconds_to_wait_for_schema_sync()` seconds, with increasing intervals between polls.
+
+    Args:
+        columns: The `table.column` combinations to wait for, e.g. `required_columns(data_sets)`
+
+    Returns:
+        The fields of the database from the last poll
+    """
+    wait = SchemaSyncWait(columns)
+    while True:
+        fields = client.get(f'/api/database/{db_id}/fields')
+        if wait.finished(fields):
+            return fields
+        time.sleep(wait.interval)
+
+
+async def wait_for_schema_sync_async(client: 'AsyncMetabaseClient', db_id: int, columns: {str}) -> [dict]:
+    """Like `wait_for_schema_sync`, with an async client"""
+    import asyncio
+
+    with instrumentation.phase('schema sync wait'):
+        wait = SchemaSyncWait(columns)
+        while True:
+            fields = await client.get(f'/api/database/{db_id}/fields')
+            if wait.finished(fields):
+                return fields
+            await asyncio.sleep(wait.interval)
+
+
+class SchemaSyncWait(object):
+    def __init__(self, columns: {str}):
+        """
+        Decides when a schema sync is finished, from consecutive polls of the field list of a database:
+
+            wait = SchemaSyncWait(columns)
+            while not wait.finished(client.get(f'/api/database/{db_id}/fields')):
+                time.sleep(wait.interval)
+
+        Metabase adds the tables & fields of a schema sync one after the other, so apart from all given
+        columns being known, the number of tables & fields also needs to be the same in two consecutive polls.
+
+        Args:
+            columns: The `table.column` combinations that need to be known to Metabase
+        """
+        self.columns = columns
+        self.start = time.monotonic()
+        self.interval = None
+        self.counts = None
+
+    def finished(self, fields: [dict]) -> bool:
+        """Prints the progress of the schema sync and returns whether to stop waiting before the next poll"""
+        counts = (len({field['table_name'] for field in fields}), len(fields))
+        settled = counts == self.counts
+        missing = self.columns - {f'{field["table_name"]}.{field["name"]}' for field in fields}
+        elapsed = time.monotonic() - self.start
+        self.counts = counts
+        self.interval = 0.5 if self.interval is None else min(self.interval * 2, 10)
+
+        timeout = config.seconds_to_wait_for_schema_sync()
+        if settled and not missing:
+            print(f'.. Schema sync finished after {elapsed:.1f} seconds')
+            return True
+        if elapsed + self.interval > timeout:
+            print(f'Schema sync not finished after {timeout} seconds, '
+                  + ('missing columns: ' + ', '.join(sorted(missing)[:10]) + (' ..' if len(missing) > 10 else '')
+                     if missing else 'number of fields still changing'), file=sys.stderr)
+            return True
+        if missing:
+            print(f'.. Waiting for schema sync ({len(missing)} columns missing)')
+        else:
+            print(f'.. Waiting for schema sync ({counts[0]} tables, {counts[1]} fields)')
+        return False
+
+
+def required_columns(data_sets: {str: 'DataSet'}) -> {str}:
+    """All `table.column` combinations that are needed for syncing the metadata of the data sets"""
+    from mara_schema.metric import SimpleMetric
+
+    columns = set()
+    for name, data_set in data_sets.items():
+        columns |= {f'{name}.{column}' for column in _attributes_by_column(data_set).keys()}
+        columns |= {f'{name}.{metric.name}' for metric in data_set.metrics.values() if isinstance(metric, SimpleMetric)}
+    return columns
+
+
+def _missing_columns(database_fields: [dict], data_sets: dict) -> {str}:
+    """All `table.column` combinations of the data sets that are not (yet) in the fields of a database"""
+    return required_columns(data_sets) - {f'{field["table_name"]}.{field["name"]}' for field in database_fields}
+
+
+def _attributes_by_column(data_set) -> {str: 'Attribute'}:
+    """All attributes of a data set by the name of the column in the data set table"""
+    _attributes = {}
+    for path, attributes in data_set.connected_attributes().items():
+        for name, attribute in attributes.items():
+            _attributes[name] = attribute
+    return _attributes
+
+
+def _diff(current: dict, desired: dict) -> {str: tuple}:
+    """The attributes in `desired` that have a different value in `current`, as {key: (current, desired)}
+
+    `revision_message` is not part of an object's state and is therefore ignored. Metric definitions are
+    compared in normalized form, because Metabase returns them differently than they were sent.
+    """
+    return {key: (current.get(key), value) for key, value in desired.items()
+            if key != 'revision_message'
+            and (_normalized_mbql(current.get(key)) != _normalized_mbql(value) if key == 'definition'
+                 else current.get(key) != value)}
+
+
+def _normalized_mbql(mbql):
+    """
+    Brings an MBQL query into the form in which Metabase returns stored queries: clause names & keys in
+    lower-case kebab-case, and field references as `['field', id, options]` (`['field-id', id]` before 0.39)
+    """
+    if isinstance(mbql, dict):
+        return {key.lower().replace('_', '-') if isinstance(key, str) else key: _normalized_mbql(value)
+                for key, value in mbql.items()}
+    if isinstance(mbql, list):
+        if mbql and isinstance(mbql[0], str):
+            name = mbql[0].lower().replace('_', '-')
+            if name == 'field-id' and len(mbql) == 2:
+                return ['field', mbql[1], None]
+            if name == 'field' and len(mbql) in (2, 3):
+                options = mbql[2] if len(mbql) == 3 else None
+                return ['field', _normalized_mbql(mbql[1]), _normalized_mbql(options) if options else None]
+            return [name] + [_normalized_mbql(value) for value in mbql[1:]]
+        return [_normalized_mbql(value) for value in mbql]
+    return mbql
+
+
+def _abbreviate(value, max_length: int = 80) -> str:
+    """A short representation of a value for printing diffs"""
+    text = repr(value)
+    return text if len(text) <= max_length else text[:max_length - 3] + '...'
+
+
 # These are functions to be patchable
 
-def metabase_description(item: t.Union[SimpleMetric, ComposedMetric, Attribute]) -> str:
+def metabase_description(item: t.Union['SimpleMetric', 'ComposedMetric', 'Attribute']) -> str:
     """Return the description of this item"""
     return item.description
 
 
-def metabase_aggregation_definition(_metric: t.Union[SimpleMetric, ComposedMetric], table: dict) -> t.List:
+def metabase_aggregation_definition(_metric: t.Union['SimpleMetric', 'ComposedMetric'], table: dict) -> t.List:
     """Return the aggregation definition suitable to be send as part of the payload to the metabase /api/metric endpoint"""
+    from mara_schema.metric import SimpleMetric
+
     if isinstance(_metric, SimpleMetric):
         return metric_definition(_metric, table)
     else:
@@ -118,11 +685,21 @@ def metabase_aggregation_definition(_metric: t.Union[SimpleMetric, ComposedMetri
                 ]
 
 
-def metric_definition(metric: Metric, table: dict) -> []:
+# compiled metric definitions by (metric, table id), reset at the start of each metadata sync
+_metric_definitions = {}
+
+
+def metric_definition(metric: 'Metric', table: dict) -> []:
     """Turn a Mara Schema metric into a a formula that Metabase understands"""
+    key = (metric, table['id'])
+    if key not in _metric_definitions:
+        _metric_definitions[key] = _compile_metric_definition(metric, table)
+    return _metric_definitions[key]
 
-    from sympy.parsing import sympy_parser
-    from sympy.core.expr import Expr
+
+def _compile_metric_definition(metric: 'Metric', table: dict) -> []:
+    from mara_schema.metric import SimpleMetric, ComposedMetric, Aggregation
+    from . import formula
 
     if isinstance(metric, SimpleMetric):
         field = next(filter(lambda f: f['name'] == metric.name, table['fields']), None)
@@ -138,36 +715,13 @@ def metric_definition(metric: Metric, table: dict) -> []:
         # assign variable names m0, m1, ... for all parent metrics
         parent_metrics = {f'm{i}': metric for i, metric in enumerate(metric.parent_metrics)}
 
+        def parent_metric_definition(name):
+            if name not in parent_metrics:
+                raise NotImplementedError(f'Unknown symbol {name}')
+            return metric_definition(parent_metrics[name], table)
+
         # render metric formula with m0, m1 as variables
-        formula = metric.formula_template.format(*parent_metrics.keys())
-
-        # parse expression with minimal transformations
-        expression = sympy_parser.parse_expr(formula,
-                                             transformations=[sympy_parser.auto_symbol, sympy_parser.auto_number],
-                                             evaluate=False)
-        assert (isinstance(expression, Expr))  # make sure it's an algebraic expression
-
-        def s_expression(x):
-            """Helper function for turning a sympy expression into something Metabase understands"""
-            if isinstance(x, Expr):
-                if x.is_Add:
-                    return ['+', *map(s_expression, x.args)]
-                if x.is_Mul:
-                    return ['*', *map(s_expression, x.args)]
-                if x.is_Pow and x.exp == -1:  # for some reason a / b is turned into a * b**-1
-                    return ['/', 1, s_expression(x.base)]
-                if x.is_Float:
-                    return float(x)
-                if x.is_Integer:
-                    return int(x)
-                if x.is_symbol:
-                    if x.name not in parent_metrics:
-                        raise NotImplementedError(f'Unknown symbol {x.name}')
-                    return metric_definition(parent_metrics[x.name], table)
-                else:
-                    raise NotImplementedError(f'Formula generation not implemented for {type(x)}')
-
-        return s_expression(expression)
+        return formula.to_mbql(metric.formula_template.format(*parent_metrics.keys()), parent_metric_definition)
 
     else:
         assert False
@@ -0,0 +1,110 @@
+"""
+Writing field, table & metric metadata in bulk directly to the Metabase metadata database
+
+Much faster than the API for large syncs, but bypasses the revision history of metrics.
+"""
+
+import functools
+import json
+import re
+
+from . import config
+
+# the columns (and their types) that can be written, per api endpoint
+_entities = {
+    'field': ('metabase_field', {'description': 'TEXT', 'visibility_type': 'TEXT'}),
+    'table': ('metabase_table', {'description': 'TEXT', 'show_in_getting_started': 'BOOLEAN',
+                                 'field_order': 'TEXT', 'visibility_type': 'TEXT'}),
+    'metric': ('metric', {'name': 'TEXT', 'description': 'TEXT', 'table_id': 'INTEGER', 'definition': 'TEXT',
+                          'show_in_getting_started': 'BOOLEAN', 'how_is_this_calculated': 'TEXT',
+                          'archived': 'BOOLEAN'}),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def is_supported() -> bool:
+    """Whether the metadata db has all tables & columns that are written (checked once per process)"""
+    import mara_db.postgresql
+
+    with mara_db.postgresql.postgres_cursor_context(config.metabase_metadata_db_alias()) as cursor:
+        cursor.execute("""
+SELECT table_name, column_name
+FROM information_schema.columns
+WHERE table_schema = current_schema() AND table_name IN %s""",
+                       (tuple(table for table, _ in _entities.values()),))
+        existing_columns = set(cursor.fetchall())
+
+    missing_columns = [f'{table}.{column}' for table, columns in _entities.values()
+                       for column in list(columns) + ['id', 'updated_at']
+                       if (table, column) not in existing_columns]
+    if missing_columns:
+        print(f'.. Metabase metadata db schema not supported (missing {", ".join(missing_columns)}), using the api')
+        return False
+    return True
+
+
+def apply_writes(writes: [(str, str, dict)]) -> [(str, str, dict)]:
+    """
+    Applies api writes to fields, tables & metrics in a single transaction in the metadata db
+
+    Args:
+        writes: A list of (method, path, data) api requests
+
+    Returns:
+        The writes that can not be done through the metadata db and need to be sent to the api
+    """
+    import mara_db.postgresql
+    from psycopg2.extras import execute_values
+
+    updates = {}  # (entity, columns) -> [(id, values..)]
+    inserts = {}  # columns -> [(values..)]
+    remaining = []
+    for method, path, data in writes:
+        match = re.fullmatch(r'/api/(field|table|metric)(?:/(\d+))?', path)
+        columns = tuple(sorted(key for key in (data or {}) if key != 'revision_message'))
+        entity = match.group(1) if match else None
+        if not match or not set(columns) <= set(_entities[entity][1]):
+            remaining.append((method, path, data))
+        elif method == 'PUT' and match.group(2):
+            updates.setdefault((entity, columns), []).append(
+                (int(match.group(2)),) + tuple(_value(data[column]) for column in columns))
+        elif method == 'POST' and entity == 'metric' and not match.group(2):
+            inserts.setdefault(columns, []).append(tuple(_value(data[column]) for column in columns))
+        else:
+            remaining.append((method, path, data))
+
+    if not updates and not inserts:
+        return remaining
+
+    with mara_db.postgresql.postgres_cursor_context(config.metabase_metadata_db_alias()) as cursor:
+        for (entity, columns), rows in updates.items():
+            table, types = _entities[entity]
+            execute_values(cursor, f"""
+UPDATE {table}
+SET {', '.join(f'{column} = new_values.{column}' for column in columns)}, updated_at = current_timestamp
+FROM (VALUES %s) new_values (id, {', '.join(columns)})
+WHERE {table}.id = new_values.id""", rows,
+                           template='(%s::INTEGER, ' + ', '.join(f'%s::{types[column]}' for column in columns) + ')',
+                           page_size=len(rows))
+            print(f'.. Updated {len(rows)} rows in {table}')
+
+        if inserts:
+            cursor.execute('SELECT id FROM core_user WHERE email = %s', (config.metabase_admin_email(),))
+            creator_id = cursor.fetchone()[0]
+
+        for columns, rows in inserts.items():
+            types = _entities['metric'][1]
+            execute_values(cursor, f"""
+INSERT INTO metric (creator_id, created_at, updated_at, {', '.join(columns)})
+VALUES %s""", [(creator_id,) + row for row in rows],
+                           template='(%s, current_timestamp, current_timestamp, '
+                                    + ', '.join(f'%s::{types[column]}' for column in columns) + ')',
+                           page_size=len(rows))
+            print(f'.. Inserted {len(rows)} metrics')
+
+    return remaining
+
+
+def _value(value):
+    """Serializes nested values (e.g. metric definitions) as json"""
+    return json.dumps(value) if isinstance(value, (dict, list)) else value
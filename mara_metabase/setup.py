@@ -8,18 +8,21 @@ import json
 import uuid
 from functools import singledispatch
 
-import bcrypt
+# needed at import time for registering `db_engine` & `db_details` for the database classes of mara_db.
+# The module is only imported by the setup command (and never by the cli or the flask views).
 import mara_db.dbs
-import mara_db.postgresql
 
 from . import config
 
 
-def setup():
+def setup(dry_run: bool = False):
     """
     Sets the admin user credentials, adds a db connection and sets a few other configurations.
 
     Patch or copy this method if you want to something differently.
+
+    Args:
+        dry_run: When True, only prints the changes that would be made (with SELECTs only)
     """
     print('\033[36m.. creating admin user \033[0m')
     add_user(email=config.metabase_admin_email(),
@@ -27,10 +30,13 @@ def setup():
              last_name=config.metabase_admin_last_name(),
              password=config.metabase_admin_password(),
              is_superuser=True,
-             groups=['Administrators', 'All users'])
+             groups=['Administrators', 'All users'],
+             dry_run=dry_run)
 
     print('\033[36m.. updating databases\033[0m')
-    update_databases({config.metabase_data_db_name(): mara_db.dbs.db(config.metabase_data_db_alias())})
+    # all other databases (e.g. the sample dataset) are removed, a renamed data warehouse db keeps its cards
+    upsert_databases({config.metabase_data_db_name(): mara_db.dbs.db(config.metabase_data_db_alias())},
+                     dry_run=dry_run)
 
     print('\033[36m.. updating settings\033[0m')
     update_settings([("anon-tracking-enabled", False),
@@ -41,26 +47,84 @@ def setup():
                      ("enable-xrays", False),
                      ("report-timezone", 'Europe/Berlin'),
                      ("humanization-strategy", 'none'),
-                     ("show-homepage-data", False)])
+                     ("show-homepage-data", False)],
+                    dry_run=dry_run)
 
 
 def add_user(first_name: str, last_name: str, email: str, password: str,
-             is_superuser: bool, groups: [str]):
+             is_superuser: bool, groups: [str], dry_run: bool = False):
     """Creates a user in Metabase by writing directly to the metadata db"""
+    add_users([{'first_name': first_name, 'last_name': last_name, 'email': email, 'password': password,
+                'is_superuser': is_superuser, 'groups': groups}],
+              dry_run=dry_run)
 
-    # rebuilt password hashing logic from
-    # https://github.com/metabase/metabase/blob/master/src/metabase/models/user.clj
-    password_salt = str(uuid.uuid4())
-    encrypted_password = bcrypt.hashpw((password_salt + password).encode('utf-8'),
-                                       bcrypt.gensalt(rounds=10, prefix=b"2a")).decode("utf-8")
 
+def add_users(users: [dict], dry_run: bool = False):
+    """
+    Creates or updates a list of users and their group memberships (written in a single transaction)
+
+    Args:
+        users: A list of dicts with the arguments of `add_user` (first_name, last_name, email, password,
+               is_superuser, groups). When an email occurs several times, the last user wins.
+        dry_run: When True, only prints the changes that would be made
+    """
+    from psycopg2.extras import execute_values
+    import mara_db.postgresql
+
+    # a single upsert statement can not update the same row twice
+    users = list({user['email']: user for user in users}.values())
+    if not users:
+        return
+
+    memberships = [(user['email'], group) for user in users for group in user['groups']]
+
+    # passwords are hashed between reading the existing users and writing them, so that no transaction is
+    # kept open while hashing
     with mara_db.postgresql.postgres_cursor_context(config.metabase_metadata_db_alias()) as cursor:
-        cursor.execute(f"""
+        cursor.execute('SELECT email, first_name, last_name, is_superuser, is_active, password, password_salt '
+                       'FROM core_user WHERE email IN %s', (tuple(user['email'] for user in users),))
+        existing_users = {row[0]: row[1:] for row in cursor.fetchall()}
+
+        missing_memberships = []
+        if dry_run and memberships:
+            execute_values(cursor, """
+SELECT membership.email, membership.group_name
+FROM (VALUES %s) membership (email, group_name)
+JOIN permissions_group ON permissions_group.name::TEXT = membership.group_name
+WHERE NOT EXISTS (SELECT 1 FROM permissions_group_membership JOIN core_user ON core_user.id = user_id
+                  WHERE core_user.email = membership.email AND group_id = permissions_group.id)""",
+                           memberships, page_size=len(memberships))
+            missing_memberships = cursor.fetchall()
+
+    passwords = [(user['password'], existing_users[user['email']][4:] if user['email'] in existing_users else None)
+                 for user in users]
+
+    if dry_run:
+        for user, matches in zip(users, _check_passwords(passwords)):
+            if user['email'] not in existing_users:
+                print(f'would create user {user["email"]}')
+                continue
+            changes = ([] if matches else ['set password']) \
+                      + [f'{key}: {old!r} -> {new!r}' for key, old, new
+                         in zip(['first_name', 'last_name', 'is_superuser', 'is_active'],
+                                existing_users[user['email']][:4],
+                                [user['first_name'], user['last_name'], user['is_superuser'], True])
+                         if old != new]
+            if changes:
+                print(f'would update user {user["email"]} ({", ".join(changes)})')
+        for email, group in missing_memberships:
+            print(f'would add user {email} to group {group}')
+        return
+
+    rows = [(user['email'], user['first_name'], user['last_name'], encrypted_password, password_salt,
+             user['is_superuser'])
+            for user, (encrypted_password, password_salt) in zip(users, _hash_passwords(passwords))]
+
+    with mara_db.postgresql.postgres_cursor_context(config.metabase_metadata_db_alias()) as cursor:
+        execute_values(cursor, """
 INSERT INTO core_user (email, first_name, last_name, password, password_salt,
                        date_joined, is_superuser, is_active)
-VALUES ({'%s'}, {'%s'}, {'%s'},
-        {'%s'}, {'%s'},
-        current_timestamp, {'%s'}, TRUE)
+VALUES %s
 ON CONFLICT (email) DO UPDATE
    SET first_name=EXCLUDED.first_name,
        last_name=EXCLUDED.last_name,
@@ -68,18 +132,87 @@ ON CONFLICT (email) DO UPDATE
        password_salt=EXCLUDED.password_salt,
        is_superuser=EXCLUDED.is_superuser,
        is_active=EXCLUDED.is_active
-""", (email, first_name, last_name, encrypted_password, password_salt, is_superuser))
-        print(cursor.query.decode('utf-8'))
+""", rows, template='(%s, %s, %s, %s, %s, current_timestamp, %s, TRUE)', page_size=len(rows))
+        print(f'upserted {len(rows)} users into core_user')
 
-        cursor.execute(f'''
+        if memberships:
+            execute_values(cursor, """
 INSERT INTO permissions_group_membership (user_id, group_id)
 SELECT core_user.id, permissions_group.id
-FROM core_user, permissions_group
-WHERE email = {'%s'} AND permissions_group.name::TEXT IN {'%s'}
+FROM (VALUES %s) membership (email, group_name)
+JOIN core_user ON core_user.email = membership.email
+JOIN permissions_group ON permissions_group.name::TEXT = membership.group_name
 ON CONFLICT DO NOTHING;
-    ''',
-                       (email, tuple(groups)))
-        print(cursor.query.decode('utf-8'))
+""", memberships, page_size=len(memberships))
+            print(f'added up to {len(memberships)} group memberships')
+
+
+def _hash_passwords(passwords: [(str, (str, str))]) -> [(str, str)]:
+    """
+    Hashes passwords on a process pool, reusing existing hashes when they match the password
+
+    Checking a password is as expensive as hashing it (both run bcrypt with the cost of the hash), so reusing
+    hashes is not faster. It only avoids rewriting the hashes & salts of unchanged passwords.
+
+    Args:
+        passwords: A list of (password, existing (hash, salt) or None)
+
+    Returns:
+        A list of (hash, salt)
+    """
+    return _run_on_process_pool(_check_or_hash_password, passwords)
+
+
+def _check_passwords(passwords: [(str, (str, str))]) -> [bool]:
+    """Whether each (password, existing (hash, salt) or None) matches, checked with bcrypt on a process pool"""
+    to_check = [i for i, (_, existing) in enumerate(passwords) if existing and existing[0]]
+    results = [False] * len(passwords)
+    for i, matches in zip(to_check, _run_on_process_pool(_check_password, [(passwords[i][0],) + tuple(passwords[i][1])
+                                                                           for i in to_check])):
+        results[i] = matches
+    return results
+
+
+def _run_on_process_pool(fn, args: list) -> list:
+    """Maps a function over a list of arguments with `config.password_hashing_processes()` processes"""
+    from concurrent.futures import ProcessPoolExecutor
+
+    processes = config.password_hashing_processes()
+    if len(args) <= 1 or processes == 1:
+        return list(map(fn, args))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(fn, args))
+
+
+def _hash_password(password: str) -> (str, str):
+    """Returns a (hash, salt) for a password"""
+    import bcrypt
+
+    # rebuilt password hashing logic from
+    # https://github.com/metabase/metabase/blob/master/src/metabase/models/user.clj
+    password_salt = str(uuid.uuid4())
+    encrypted_password = bcrypt.hashpw((password_salt + password).encode('utf-8'),
+                                       bcrypt.gensalt(rounds=10, prefix=b"2a")).decode("utf-8")
+    return encrypted_password, password_salt
+
+
+def _check_or_hash_password(args: (str, (str, str))) -> (str, str):
+    """Returns the existing (hash, salt) of a (password, existing (hash, salt) or None) when it matches, or a new one"""
+    password, existing = args
+    if existing and existing[0] and _check_password((password,) + tuple(existing)):
+        return tuple(existing)
+    return _hash_password(password)
+
+
+def _check_password(args: (str, str, str)) -> bool:
+    """Whether a (password, hash, salt) combination matches"""
+    import bcrypt
+
+    password, encrypted_password, password_salt = args
+    try:
+        return bcrypt.checkpw((password_salt + password).encode('utf-8'), encrypted_password.encode('utf-8'))
+    except ValueError:  # not a valid bcrypt hash
+        return False
 
 
 @singledispatch
@@ -115,17 +248,35 @@ def __(db: mara_db.dbs.SQLServerDB):
     return {"host": db.host, "instance": "MSSQLSERVER", "port": db.port, "db": db.database, "user": db.user, "ssl": False,
             "password": db.password, "additional-options": "encrypt=true", "tunnel-endabled": False}
 
-def update_databases(databases: {str: mara_db.dbs.DB}):
+def update_databases(databases: {str: mara_db.dbs.DB}, dry_run: bool = False):
     """
     Creates or updates a list of databases in the Metabase metadata db (and removes all others)
 
     Args:
         databases: A mapping of database names to database configurations
+        dry_run: When True, only prints the changes that would be made
     """
+    import mara_db.postgresql
+
     with mara_db.postgresql.postgres_cursor_context(config.metabase_metadata_db_alias()) as cursor:
         cursor.execute('SELECT id, name FROM metabase_database')
         existing_database_ids = {name: id for id, name in cursor.fetchall()}
 
+        if dry_run:
+            if len(existing_database_ids) != len(databases):
+                print(f'would remove databases {", ".join(existing_database_ids) or "-"} (including all cards) '
+                      f'and create {", ".join(databases)}')
+            else:
+                cursor.execute('SELECT id, name, engine, details FROM metabase_database')
+                existing = {id: (name, engine, details) for id, name, engine, details in cursor.fetchall()}
+                for name, id in zip(databases.keys(), existing_database_ids.values()):
+                    db = databases[name]
+                    existing_name, engine, details = existing[id]
+                    if (existing_name, engine, json.loads(details) if details else None) \
+                            != (name, db_engine(db), db_details(db)):
+                        print(f'would update database {existing_name} (id {id}) to {name}')
+            return
+
         if len(existing_database_ids) != len(databases):
             cursor.execute(f"TRUNCATE metabase_database CASCADE;")
             print(cursor.query.decode('utf-8'))
@@ -150,15 +301,95 @@ WHERE id = {'%s'};
                 print(cursor.query.decode('utf-8'))
 
 
-def update_settings(settings: [(str, str)]):
+def upsert_databases(databases: {str: mara_db.dbs.DB}, remove_others: bool = True, dry_run: bool = False):
+    """
+    Creates or updates a list of databases (by name) in the Metabase metadata db with a single statement
+
+    Unlike `update_databases`, existing databases keep their ids, cards and sync state.
+
+    Args:
+        databases: A mapping of database names to database configurations
+        remove_others: When True, all databases that are not in `databases` are deleted (including their cards).
+                       Nothing is deleted when `databases` is empty. Like in `update_databases`, when a single
+                       database is passed that does not exist yet and there is exactly one other (non sample)
+                       database, that database is renamed instead, which keeps its cards.
+        dry_run: When True, only prints the changes that would be made
+    """
+    from psycopg2.extras import execute_values
+    import mara_db.postgresql
+
+    if not databases:
+        return
+
+    rows = [(name, json.dumps(db_details(db)), db_engine(db)) for name, db in databases.items()]
+
+    with mara_db.postgresql.postgres_cursor_context(config.metabase_metadata_db_alias()) as cursor:
+        cursor.execute('SELECT name, is_sample FROM metabase_database')
+        existing_databases = dict(cursor.fetchall())
+
+        other_names = [name for name, is_sample in existing_databases.items()
+                       if name not in databases and not is_sample]
+        renamed_name = other_names[0] if (remove_others and len(databases) == 1 and len(other_names) == 1
+                                          and not set(databases) & set(existing_databases)) else None
+
+        if dry_run:
+            for name in databases:
+                if renamed_name:
+                    print(f'would rename database {renamed_name} to {name} and update it')
+                else:
+                    print(f'would {"update" if name in existing_databases else "create"} database {name}')
+            if remove_others:
+                for name in sorted(set(existing_databases) - set(databases) - {renamed_name}):
+                    print(f'would remove database {name} (including all cards)')
+            return
+
+        if renamed_name:
+            cursor.execute('UPDATE metabase_database SET name = %s WHERE name = %s',
+                           (next(iter(databases)), renamed_name))
+            print(cursor.query.decode('utf-8'))
+
+        execute_values(cursor, """
+WITH new_database (name, details, engine) AS (VALUES %s),
+     updated_database AS (
+         UPDATE metabase_database
+         SET details = new_database.details, engine = new_database.engine,
+             is_sample = FALSE, updated_at = current_timestamp
+         FROM new_database
+         WHERE metabase_database.name = new_database.name
+         RETURNING metabase_database.name)
+INSERT INTO metabase_database (created_at, updated_at, name, details, engine, is_sample)
+SELECT current_timestamp, current_timestamp, name, details, engine, FALSE
+FROM new_database
+WHERE name NOT IN (SELECT name FROM updated_database)
+""", rows, page_size=len(rows))
+        print(cursor.query.decode('utf-8'))
+
+        if remove_others:
+            cursor.execute('DELETE FROM metabase_database WHERE name NOT IN %s', (tuple(databases.keys()),))
+            print(cursor.query.decode('utf-8'))
+
+
+def update_settings(settings: [(str, str)], dry_run: bool = False):
     """
     Sets a list of settings (key, value)
 
     See https://git.xyser.com/Test/metabase/blob/master/src/metabase/public_settings.clj
     """
     from psycopg2.extras import execute_values
+    import mara_db.postgresql
 
     with mara_db.postgresql.postgres_cursor_context(config.metabase_metadata_db_alias()) as cursor:
+        if dry_run:
+            cursor.execute('SELECT key, value FROM setting')
+            existing_settings = dict(cursor.fetchall())
+            for key, value in settings:
+                # values are stored as text, booleans in lower case
+                if existing_settings.get(key) not in (str(value), str(value).lower()):
+                    print(f'would set {key}: {existing_settings.get(key)!r} -> {value!r}')
+            if 'setup-token' in existing_settings:
+                print('would delete setup-token')
+            return
+
         execute_values(cursor, f"""
 INSERT INTO setting (key, value)
 VALUES {'%s'}
@@ -0,0 +1,250 @@
+"""
+Export & import of the metadata and permissions of a Metabase database, for cloning environments
+
+Snapshots contain table & field descriptions, visibility, metrics and the permission graph of a database.
+All objects are referenced by name rather than by id, so that a snapshot of one Metabase instance can be
+applied to another one (e.g. a freshly set up test environment) without a full `update_metadata`.
+"""
+
+import json
+import sys
+
+from . import catalog, config, instrumentation
+from .client import MetabaseClient, execute_concurrently
+
+# the attributes of tables, fields & metrics that are part of a snapshot
+_table_keys = ['description', 'visibility_type', 'show_in_getting_started', 'field_order']
+_field_keys = ['description', 'visibility_type']
+_metric_keys = ['description', 'definition', 'show_in_getting_started', 'how_is_this_calculated']
+
+
+def export_snapshot(path: str, db_name: str = None):
+    """
+    Writes the metadata & permissions of a Metabase database to a json file
+
+    Args:
+        path: The file to write, gzip compressed when it ends with `.gz`
+        db_name: The Metabase database, defaults to `config.metabase_data_db_name()`
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    client = MetabaseClient()
+    db_name = db_name or config.metabase_data_db_name()
+    db_id = catalog.database_id(client, db_name)
+
+    with instrumentation.phase('snapshot export'):
+        tables = client.get(f'/api/database/{db_id}?include=tables')['tables']
+        catalog.set_tables(db_id, tables)
+
+        with ThreadPoolExecutor(max_workers=max(1, config.metadata_sync_concurrency())) as executor:
+            tables_metadata = list(executor.map(
+                lambda table: client.get(f'/api/table/{table["id"]}/query_metadata'
+                                         f'?include_sensitive_fields=true&include_hidden_fields=true'),
+                tables))
+
+        # metrics can reference the fields of other tables (e.g. in `fk->` clauses)
+        field_names = {field['id']: f'{table["name"]}.{field["name"]}'
+                       for table in tables_metadata for field in table['fields']}
+        source_tables = {table['id']: table['name'] for table in tables}
+        not_found = []
+
+        snapshot_tables = {}
+        for table in tables_metadata:
+            snapshot_tables[table['name']] = dict(
+                {key: table.get(key) for key in _table_keys},
+                fields={field['name']: {key: field.get(key) for key in _field_keys} for field in table['fields']},
+                metrics={metric['name']: dict({key: metric.get(key) for key in _metric_keys},
+                                              definition=_map_references(metric['definition'], field_names,
+                                                                         source_tables, not_found))
+                         for metric in table['metrics'] if not metric.get('archived')})
+
+        group_names = {str(group_id): name for name, group_id in catalog.group_ids(client).items()}
+        table_names = {str(table['id']): table['name'] for table in tables}
+        permissions = {}
+        for group_id, databases in client.get('/api/permissions/graph')['groups'].items():
+            database_permissions = databases.get(str(db_id))
+            if database_permissions and group_id in group_names:
+                permissions[group_names[group_id]] = _map_table_permissions(database_permissions, table_names, [])
+
+    with _open(path, 'w') as f:
+        json.dump({'database': db_name, 'tables': snapshot_tables, 'permissions': permissions}, f,
+                  sort_keys=True, separators=(',', ':'))
+
+    print(f'.. Exported metadata of {len(snapshot_tables)} tables & permissions of {len(permissions)} groups '
+          f'to {path}')
+    if not_found:
+        print(f'{len(set(not_found))} references of metrics not found in the database (not importable): '
+              + ', '.join(sorted(set(not_found))), file=sys.stderr)
+
+
+def import_snapshot(path: str, db_name: str = None, dry_run: bool = False) -> bool:
+    """
+    Applies a snapshot that was written by `export_snapshot` to a Metabase database
+
+    Triggers a schema sync of the database and waits until Metabase knows all tables & fields of the snapshot.
+    Then all metadata is written in bulk (through the metadata db when `config.metadata_sync_backend()` is
+    'sql'), and the permissions are applied to the groups of the same name (missing groups are created).
+    Field values are not rescanned, Metabase does that in its next scheduled scan.
+
+    Args:
+        path: A snapshot file
+        db_name: The Metabase database, defaults to the database of the snapshot
+        dry_run: When True, only prints the changes that would be made (with read requests only)
+
+    Returns:
+        True when all objects of the snapshot were found and written
+    """
+    from . import acl, metadata
+
+    with _open(path, 'r') as f:
+        snapshot = json.load(f)
+
+    client = MetabaseClient(dry_run=dry_run)
+    db_id = catalog.database_id(client, db_name or snapshot['database'])
+
+    print(f'.. Triggering schema sync of database {db_id}')
+    client.post(f'/api/database/{db_id}/sync_schema')
+
+    columns = {f'{table_name}.{field_name}'
+               for table_name, table in snapshot['tables'].items() for field_name in table['fields']}
+
+    if dry_run:
+        fields = client.get(f'/api/database/{db_id}/fields')
+    else:
+        fields = metadata.wait_for_schema_sync(client, db_id, columns)
+
+    with instrumentation.phase('snapshot import'):
+        field_ids = {}
+        for field in fields:
+            field_ids.setdefault(field['table_name'], {})[field['name']] = field['id']
+        reference_ids = {f'{field["table_name"]}.{field["name"]}': field['id'] for field in fields}
+        tables = client.get(f'/api/database/{db_id}?include=tables')['tables']
+        catalog.set_tables(db_id, tables)
+        table_ids = {table['name']: table['id'] for table in tables}
+        metric_ids = {(metric['table_id'], metric['name']): metric['id'] for metric in client.get('/api/metric')}
+
+        writes = []
+        not_found = []
+        references_not_found = []
+        for table_name, table in sorted(snapshot['tables'].items()):
+            if table_name not in table_ids:
+                not_found.append(table_name)
+                continue
+            table_id = table_ids[table_name]
+            writes.append(('PUT', f'/api/table/{table_id}', {key: table[key] for key in _table_keys}))
+
+            for field_name, field in table['fields'].items():
+                if field_name in field_ids.get(table_name, {}):
+                    writes.append(('PUT', f'/api/field/{field_ids[table_name][field_name]}', field))
+                else:
+                    not_found.append(f'{table_name}.{field_name}')
+
+            for metric_name, metric in table['metrics'].items():
+                data = dict(metric, name=metric_name, table_id=table_id, revision_message='Snapshot import',
+                            definition=_map_references(metric['definition'], reference_ids, table_ids,
+                                                       references_not_found))
+                if (table_id, metric_name) in metric_ids:
+                    writes.append(('PUT', f'/api/metric/{metric_ids[(table_id, metric_name)]}', data))
+                else:
+                    writes.append(('POST', '/api/metric', data))
+        not_found += sorted(set(references_not_found) - set(not_found))
+
+        print(f'.. {"Would write" if dry_run else "Writing"} {len(writes)} objects')
+        instrumentation.record_changes('metadata', len(writes))
+        if config.metadata_sync_backend() == 'sql' and not dry_run:
+            from . import metadata_db
+            if metadata_db.is_supported():
+                writes = metadata_db.apply_writes(writes)
+        errors = execute_concurrently(client, writes, config.metadata_sync_concurrency())
+
+    with instrumentation.phase('permission graph'):
+        metabase_groups = catalog.group_ids(client)
+        for group_name in sorted(set(snapshot['permissions']) - set(metabase_groups)):
+            metabase_groups[group_name] = acl.create_group(client, group_name)
+        table_ids = {table_name: str(table_id) for table_name, table_id in table_ids.items()}
+        tables_not_found = []
+        acl.put_permission_graph_changes(
+            client, metabase_groups,
+            {metabase_groups[group_name]: {db_id: _map_table_permissions(database_permissions, table_ids,
+                                                                         tables_not_found)}
+             for group_name, database_permissions in snapshot['permissions'].items()},
+            {db_id: catalog.tables(client, db_id)})
+        not_found += sorted(set(tables_not_found) - set(not_found))
+
+    if not_found:
+        print(f'{len(not_found)} tables & fields of the snapshot not found in Metabase: '
+              + ', '.join(not_found[:10]) + (' ..' if len(not_found) > 10 else ''), file=sys.stderr)
+    if errors:
+        metadata.report_errors(errors)
+    return not (errors or not_found)
+
+
+def _map_references(definition, fields: dict, tables: dict, not_found: [str]):
+    """
+    Replaces the field & table references in a metric definition (ids by names for exports, names by ids for imports)
+
+    Fields are referenced as `table.field` in snapshots, so that references to other tables (e.g. in `fk->`
+    clauses) can be mapped as well. References that are not in `fields` or `tables` are kept and appended
+    to `not_found`.
+
+    Args:
+        definition: A metric definition (MBQL)
+        fields: The field ids of all tables of the database by `table.field` name, or these names by id
+        tables: Table ids by name or names by id
+        not_found: The references that could not be mapped
+    """
+    def map_reference(reference, mapping: dict):
+        if reference in mapping:
+            return mapping[reference]
+        not_found.append(str(reference))
+        return reference
+
+    if isinstance(definition, list):
+        if len(definition) >= 2 and definition[0] in ('field-id', 'field'):
+            options = [_map_references(value, fields, tables, not_found) for value in definition[2:]]
+            if (definition[0] == 'field' and isinstance(definition[1], str) and definition[1] not in fields
+                    and options and isinstance(options[0], dict) and 'base-type' in options[0]):
+                # a column of a nested query, which is referenced by its name (with a type) instead of an id
+                return [definition[0], definition[1]] + options
+            return [definition[0], map_reference(definition[1], fields)] + options
+        return [_map_references(value, fields, tables, not_found) for value in definition]
+    elif isinstance(definition, dict):
+        return {key: map_reference(value, tables) if key == 'source-table'
+                else map_reference(value, fields) if key == 'source-field'
+                else _map_references(value, fields, tables, not_found)
+                for key, value in definition.items()}
+    else:
+        return definition
+
+
+def _map_table_permissions(database_permissions: dict, tables: {str: str}, not_found: [str]) -> dict:
+    """
+    Replaces the table keys in the permissions of a group for a database (ids by names or names by ids)
+
+    Tables that are not in `tables` are dropped from the permissions and appended to `not_found`.
+    """
+    schemas = database_permissions.get('schemas')
+    if not isinstance(schemas, dict):
+        return database_permissions
+
+    def map_tables(table_permissions: dict) -> dict:
+        mapped = {}
+        for table, permission in table_permissions.items():
+            if str(table) in tables:
+                mapped[tables[str(table)]] = permission
+            else:
+                not_found.append(str(table))
+        return mapped or 'none'
+
+    return dict(database_permissions,
+                schemas={schema: map_tables(table_permissions) if isinstance(table_permissions, dict)
+                         else table_permissions
+                         for schema, table_permissions in schemas.items()})
+
+
+def _open(path: str, mode: str):
+    """Opens a text file, gzip compressed when the file name ends with `.gz`"""
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
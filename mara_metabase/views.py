@@ -1,14 +1,36 @@
 
+import threading
+
 import flask
 from mara_page import acl, navigation
 
 blueprint = flask.Blueprint('mara_metabase', __name__, url_prefix='/')
 
 
-acl_resource = acl.AclResource(name='Metabase')
+class _DataSetsAclResource(acl.AclResource):
+    def __init__(self, name: str):
+        """An acl resource with a child for each data set, which are only created when first accessed"""
+        self._lock = threading.RLock()
+        super().__init__(name=name)
+        self._children = None
+
+    @property
+    def children(self):
+        with self._lock:
+            if self._children is None:  # configuration needs to be loaded before we can access it
+                self._children = []
+                _create_acl_resource_for_each_data_set()
+            return self._children
+
+    @children.setter
+    def children(self, children):
+        """Set to None to re-create the data set resources on next access"""
+        self._children = children
+
+
+acl_resource = _DataSetsAclResource(name='Metabase')
 
 
-@blueprint.before_app_first_request  # configuration needs to be loaded before we can access it
 def _create_acl_resource_for_each_data_set():
     import mara_schema.config
     for data_set in mara_schema.config.data_sets():
@@ -28,3 +50,35 @@ def metabase():
     from . import config
 
     return flask.redirect(config.external_metabase_url())
+
+
+@blueprint.route('/metabase/sync-status')
+@acl.require_permission(acl_resource)
+def sync_status():
+    import mara_acl.views
+    from mara_page import bootstrap, response, _
+    from . import jobs
+
+    pending, running, results = jobs.status()
+
+    # tracebacks can contain Metabase error responses, only users who can administer Mara ACL see them
+    show_tracebacks = acl.current_user_has_permission(mara_acl.views.acl_resource)
+
+    def error_html(error: str):
+        return _.pre[error if show_tracebacks else error.strip().splitlines()[-1]]
+
+    return response.Response(
+        title='Metabase sync status',
+        html=[bootstrap.card(header_left='Pending & running',
+                             body=bootstrap.table(
+                                 ['Job', 'State'],
+                                 [_.tr[_.td[description], _.td['running']] for description in running or []]
+                                 + [_.tr[_.td[description], _.td['pending']] for description in pending])),
+              bootstrap.card(header_left='Recent syncs',
+                             body=bootstrap.table(
+                                 ['Started', 'Jobs', 'Duration', 'Result'],
+                                 [_.tr[_.td[result.started_at.strftime('%Y-%m-%d %H:%M:%S')],
+                                       _.td[', '.join(result.descriptions)],
+                                       _.td[f'{result.duration:.1f}s'],
+                                       _.td[error_html(result.error) if result.error else 'ok']]
+                                  for result in results]))])
@@ -19,11 +19,14 @@ setup(
     install_requires=[
         'mara-db>=4.7.1',
         'mara-page',
-        'sympy',
         'bcrypt',
         'requests'
     ],
 
+    extras_require={
+        'async': ['aiohttp>=3.6; python_version >= "3.7"'],
+    },
+
     python_requires='>=3.6',
 
     packages=find_packages(),
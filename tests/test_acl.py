@@ -0,0 +1,88 @@
+"""Permission graph cases for the pure functions of the ACL sync"""
+
+from mara_metabase.acl import _graph_changes, _schema_permissions
+
+# table name -> {'id': .., 'schema': ..}, as returned by `catalog.tables`
+tables = {'order': {'id': 1, 'schema': 'dwh'},
+          'customer': {'id': 2, 'schema': 'dwh'},
+          'product': {'id': 3, 'schema': 'dwh'},
+          'order_item': {'id': 4, 'schema': 'dwh_tmp'},  # not a data set
+          'session': {'id': 5, 'schema': 'web'}}
+
+data_sets = {'order', 'customer', 'product', 'session'}
+
+groups = {'All Users': 1, 'Administrators': 2, 'Analysts': 3}
+
+
+def test_schema_permissions_per_table():
+    assert _schema_permissions(tables, data_sets, {'order'}) \
+           == {'dwh': {1: 'all', 2: 'none', 3: 'none'}, 'web': 'none'}
+
+
+def test_schema_permissions_whole_schema():
+    assert _schema_permissions(tables, data_sets, data_sets) == {'dwh': 'all', 'web': 'all'}
+
+
+def test_schema_permissions_schema_with_unmanaged_tables():
+    # a grant on dwh_tmp would give access to order_item, which does not belong to a data set
+    assert _schema_permissions(dict(tables, order_item={'id': 4, 'schema': 'dwh'}), data_sets, data_sets) \
+           == {'dwh': {1: 'all', 2: 'all', 3: 'all'}, 'web': 'all'}
+
+
+def test_schema_permissions_without_schema():
+    assert _schema_permissions({'order': {'id': 1, 'schema': None}}, {'order'}, {'order'}) == {'': 'all'}
+
+
+def graph(permissions: dict) -> dict:
+    return {'revision': 7, 'groups': permissions}
+
+
+def test_graph_changes_unchanged_in_expanded_form():
+    # Metabase lists each table of a schema instead of 'all', and also tables that don't belong to a data set
+    current = graph({'3': {'10': {'native': 'none',
+                                  'schemas': {'dwh': {'1': 'all', '2': 'none', '3': 'none'},
+                                              'dwh_tmp': {'4': 'all'}, 'web': {'5': 'all'}}}}})
+    desired = {3: {10: {'schemas': {'dwh': {1: 'all', 2: 'none', 3: 'none'}, 'web': 'all'}}}}
+    assert _graph_changes(current, desired, groups, {10: tables}) == {}
+
+
+def test_graph_changes_unchanged_in_collapsed_form():
+    # Metabase reports 'none' for a whole database when a group has no access at all
+    current = graph({'1': {'10': 'none'}, '3': {'10': {'native': 'none', 'schemas': 'all'}}})
+    desired = {1: {10: {'native': 'none', 'schemas': 'none'}},
+               3: {10: {'schemas': {'dwh': 'all', 'web': 'all'}}}}
+    assert _graph_changes(current, desired, groups, {10: tables}) == {}
+
+
+def test_graph_changes_missing_group_and_schema():
+    current = graph({'3': {'10': {'native': 'none', 'schemas': {'dwh': {'1': 'all'}}}}})
+    desired = {3: {10: {'schemas': {'dwh': {1: 'all', 2: 'none', 3: 'none'}, 'web': 'none'}}},
+               1: {10: {'native': 'none', 'schemas': 'none'}}}
+    assert _graph_changes(current, desired, groups, {10: tables}) == {}
+
+
+def test_graph_changes_changed_table():
+    current = graph({'3': {'10': {'schemas': {'dwh': {'1': 'all', '2': 'all', '3': 'none'}, 'web': 'none'}}}})
+    desired = {3: {10: {'schemas': {'dwh': {1: 'all', 2: 'none', 3: 'none'}, 'web': 'none'}}}}
+    assert _graph_changes(current, desired, groups, {10: tables}) \
+           == {'3': {'10': {'schemas': {'dwh': {'1': 'all', '2': 'none', '3': 'none'}, 'web': 'none'}}}}
+
+
+def test_graph_changes_sandboxed_table():
+    current = graph({'3': {'10': {'schemas': {'dwh': {'1': {'read': 'all', 'query': 'segmented'}},
+                                              'web': 'none'}}}})
+    desired = {3: {10: {'schemas': {'dwh': {1: 'all'}, 'web': 'none'}}}}
+    assert list(_graph_changes(current, desired, groups, {10: tables})) == ['3']
+
+
+def test_graph_changes_native_permissions():
+    current = graph({'2': {'10': {'native': 'none', 'schemas': 'all'}}})
+    desired = {2: {10: {'native': 'write', 'schemas': 'all'}}}
+    assert list(_graph_changes(current, desired, groups, {10: tables})) == ['2']
+
+
+def test_graph_changes_database_without_tables():
+    current = graph({'1': {'10': {'native': 'write', 'schemas': 'all'}}})
+    desired = {1: {10: {'native': 'none', 'schemas': 'none'}}}
+    assert list(_graph_changes(current, desired, groups, {})) == ['1']
+    assert _graph_changes(graph({'1': {'10': 'none'}}), desired, groups, {}) == {}
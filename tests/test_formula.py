@@ -0,0 +1,55 @@
+"""Formula -> MBQL cases, with the same output as the sympy based implementation that `formula.to_mbql` replaced"""
+
+import pytest
+
+from mara_metabase.formula import to_mbql
+
+
+@pytest.mark.parametrize('formula, expected', [
+    ('m0', 'm0'),
+    ('((m0))', 'm0'),
+    ('m0 + m1', ['+', 'm0', 'm1']),
+    ('m0 - m1', ['+', 'm0', ['*', -1, 'm1']]),
+    ('m0 * m1', ['*', 'm0', 'm1']),
+    ('m0 / m1', ['*', 'm0', ['/', 1, 'm1']]),
+    ('m0 + m1 + m2', ['+', 'm0', 'm1', 'm2']),
+    ('(m0 + m1) + m2', ['+', 'm0', 'm1', 'm2']),
+    ('m0 + (m1 + m2)', ['+', 'm0', 'm1', 'm2']),
+    ('m0 - m1 - m2', ['+', 'm0', ['*', -1, 'm1'], ['*', -1, 'm2']]),
+    ('m0 - (m1 - m2)', ['+', 'm0', ['*', -1, ['+', 'm1', ['*', -1, 'm2']]]]),
+    ('m0 * m1 * m2', ['*', 'm0', 'm1', 'm2']),
+    ('m0 / m1 / m2', ['*', 'm0', ['/', 1, 'm1'], ['/', 1, 'm2']]),
+    ('(m0 - m1) / m2', ['*', ['+', 'm0', ['*', -1, 'm1']], ['/', 1, 'm2']]),
+    ('m0 / (m1 + m2)', ['*', 'm0', ['/', 1, ['+', 'm1', 'm2']]]),
+    ('m0 * (m1 + m2) / m3', ['*', 'm0', ['+', 'm1', 'm2'], ['/', 1, 'm3']]),
+    ('(m0 + m1) * (m2 - m3)', ['*', ['+', 'm0', 'm1'], ['+', 'm2', ['*', -1, 'm3']]]),
+    ('1 - m0 / m1', ['+', 1, ['*', -1, ['*', 'm0', ['/', 1, 'm1']]]]),
+    ('100 * m0 / m1', ['*', 100, 'm0', ['/', 1, 'm1']]),
+    ('m0 / m1 * 100', ['*', 'm0', ['/', 1, 'm1'], 100]),
+    ('m0 / 1000', ['*', 'm0', ['/', 1, 1000]]),
+    ('m0 - 1', ['+', 'm0', ['*', -1, 1]]),
+    ('2.5 * m0', ['*', 2.5, 'm0']),
+    ('1.5e3 * m0', ['*', 1500.0, 'm0']),
+    ('-m0', ['*', -1, 'm0']),
+    ('-2 * m0', ['*', -2, 'm0']),
+    ('-m0 + m1', ['+', ['*', -1, 'm0'], 'm1']),
+    ('m0 + -m1', ['+', 'm0', ['*', -1, 'm1']]),
+])
+def test_to_mbql(formula, expected):
+    assert to_mbql(formula, lambda name: name) == expected
+
+
+def test_negated_parentheses():
+    # sympy multiplied this out to ['+', ['*', -1, 'm0'], ['*', -1, 'm1']]
+    assert to_mbql('-(m0 + m1)', lambda name: name) == ['*', -1, ['+', 'm0', 'm1']]
+
+
+def test_resolve_name():
+    assert to_mbql('m0 / m1', lambda name: ['sum', ['field-id', int(name[1:])]]) \
+           == ['*', ['sum', ['field-id', 0]], ['/', 1, ['sum', ['field-id', 1]]]]
+
+
+@pytest.mark.parametrize('formula', ['m0 +', '(m0 + m1', 'm0 m1', 'm0 ^ 2', 'm0 + )'])
+def test_invalid_formulas(formula):
+    with pytest.raises(ValueError):
+        to_mbql(formula, lambda name: name)
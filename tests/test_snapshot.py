@@ -0,0 +1,47 @@
+"""Reference mapping cases of metric definitions in snapshots"""
+
+import pytest
+
+pytest.importorskip('requests')
+
+from mara_metabase.snapshot import _map_references
+
+# field ids by `table.field` name of the importing instance, and the names by id of the exporting instance
+field_ids = {'order.revenue': 11, 'order.customer_fk': 12, 'customer.country': 21}
+field_names = {1: 'order.revenue', 2: 'order.customer_fk', 3: 'customer.country'}
+
+
+def test_export_and_import():
+    definition = {'source-table': 100,
+                  'aggregation': [['sum', ['field-id', 1]]],
+                  'filter': ['=', ['fk->', ['field-id', 2], ['field-id', 3]], 'DE']}
+    not_found = []
+    exported = _map_references(definition, field_names, {100: 'order'}, not_found)
+    assert exported == {'source-table': 'order',
+                        'aggregation': [['sum', ['field-id', 'order.revenue']]],
+                        'filter': ['=', ['fk->', ['field-id', 'order.customer_fk'], ['field-id', 'customer.country']],
+                                   'DE']}
+    assert _map_references(exported, field_ids, {'order': 200}, not_found) \
+           == {'source-table': 200,
+               'aggregation': [['sum', ['field-id', 11]]],
+               'filter': ['=', ['fk->', ['field-id', 12], ['field-id', 21]], 'DE']}
+    assert not_found == []
+
+
+def test_field_clauses():
+    not_found = []
+    assert _map_references(['sum', ['field', 'order.revenue', {'source-field': 'order.customer_fk'}]],
+                           field_ids, {}, not_found) == ['sum', ['field', 11, {'source-field': 12}]]
+    assert _map_references(['field', 'total', {'base-type': 'type/Float'}], field_ids, {}, not_found) \
+           == ['field', 'total', {'base-type': 'type/Float'}]
+    assert not_found == []
+
+
+def test_not_found():
+    not_found = []
+    assert _map_references({'source-table': 'session', 'aggregation': [['sum', ['field-id', 'order.discount']]],
+                            'filter': ['=', ['field', 'customer.city', None], 'Berlin']},
+                           field_ids, {'order': 200}, not_found) \
+           == {'source-table': 'session', 'aggregation': [['sum', ['field-id', 'order.discount']]],
+               'filter': ['=', ['field', 'customer.city', None], 'Berlin']}
+    assert sorted(not_found) == ['customer.city', 'order.discount', 'session']